@@ -1,5 +1,7 @@
 from argparse import ArgumentParser
+from asyncio import new_event_loop
 from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta, timezone
 from email import message_from_bytes
 from enum import Enum
@@ -8,18 +10,32 @@ from hmac import new
 from html.parser import HTMLParser
 from http.cookies import SimpleCookie
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from inspect import stack
+from itertools import count, islice
 from json import dumps, loads
+from markdown import __version__ as markdown_package_version
 from markdown import markdown
 from math import ceil
 from os import urandom
 from os.path import basename, dirname, getmtime, join, realpath
-from re import MULTILINE, split, sub
-from sys import exit
+from re import DOTALL, escape, split, sub
+from re import compile as compile_regex
+from selectors import EVENT_READ, EVENT_WRITE, DefaultSelector
+from socket import SHUT_RDWR, socket, socketpair
+from sys import exit, modules
 from threading import Lock, Thread
-from time import sleep, time
+from time import monotonic, time
 from traceback import format_exc
-from typing import Any, Callable, Iterable, Literal, TypeVar
+from types import CodeType
+from typing import (
+    Any,
+    AsyncIterable,
+    Callable,
+    Iterable,
+    Iterator,
+    Literal,
+    Match,
+    TypeVar,
+)
 from unicodedata import normalize
 from urllib.parse import parse_qs, urlencode, urlparse, quote
 from webbrowser import open as open_browser
@@ -32,6 +48,7 @@ class Encode(Enum):
 
 
 T = TypeVar("T")
+missing = object()
 
 
 def get_one(dictionary: dict[str, list[T]], key: str):
@@ -39,10 +56,6 @@ def get_one(dictionary: dict[str, list[T]], key: str):
     return value[0] if value and len(value) else None
 
 
-def resolve_filename() -> str:
-    return next(x for x in stack() if x.filename != __file__).filename
-
-
 def asdict(value: Any) -> dict[str, Any]:
     try:
         return dict((x, getattr(value, x)) for x in dir(value))
@@ -81,53 +94,156 @@ def parse_segments(template: str) -> list[tuple[bool, str]]:
     return results
 
 
-def eval_segments(
-    segments: list[tuple[bool, str]], **kwargs: Any
-) -> list[str | Any]:
-    results: list[str | Any] = []
-    for inside, value in segments:
-        if inside:
-            try:
-                value = eval(value, kwargs)
-            except Exception as e:
-                print(value, " -> ", e)
-                value = None
-        results.append(value)
-    return results
+Expression = CodeType | SyntaxError
 
 
-def match_segments(
-    template: str, string: str, segments: list[tuple[bool, str]]
-) -> dict[str, str] | None:
-    result: dict[str, str] = {}
-    offset = 0
-    limits: list[tuple[str, int, int | None]] = []
-    for inside, value in segments:
-        if inside:
-            limits.append((value.strip(), offset, None))
+class ExpressionCache:
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.files: dict[str, tuple[int, dict[str, Expression]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, source: str, path: str = "", mtime: int = 0):
+        version, codes = self.files.get(path, (mtime, None))
+        if codes is None or version != mtime or len(codes) >= self.maxsize:
+            codes = {}
+            self.files[path] = (mtime, codes)
+        code = codes.get(source)
+        if code is None:
+            self.misses += 1
+            try:
+                code = compile(source.lstrip(" \t"), path or "<fstr>", "eval")
+            except SyntaxError as e:
+                code = e
+            codes[source] = code
         else:
-            i = string.find(value, offset)
-            if i == -1:
-                return
-            offset = i + len(value)
-            if len(limits):
-                name, start, _ = limits[-1]
-                limits[-1] = (name, start, i)
-    if not len(limits):
-        return result if template == string else None
-    _, start, _ = limits[0]
-    if start != 0:
-        _, value = segments[0]
-        if value != string[0:start]:
-            return
-    _, _, end = limits[-1]
-    if end is not None:
-        _, value = segments[-1]
-        if value != string[end:]:
-            return
-    for name, start, end in limits:
-        result[name] = string[start:end]
-    return result
+            self.hits += 1
+        return code
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": sum(len(codes) for _, codes in self.files.values()),
+        }
+
+
+expressions = ExpressionCache()
+
+
+class LRUCache:
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Any, value: Any, ttl: float | None = None):
+        with self.lock:
+            expires = monotonic() + (self.ttl if ttl is None else ttl)
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(False)
+
+    def get_or_set(
+        self, key: Any, fn: Callable[[], T], ttl: float | None = None
+    ) -> T:
+        value = self.get(key, missing)
+        if value is missing:
+            value = fn()
+            self.set(key, value, ttl)
+        return value
+
+    def delete(self, key: Any):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+        }
+
+
+markdown_extensions: list[str] = []
+markdown_version = sha256(
+    dumps([markdown_package_version, markdown_extensions]).encode()
+).hexdigest()[:16]
+markdown_cache = LRUCache(1024, float("inf"))
+fragments = LRUCache(4096, 300)
+skeletons = LRUCache(256, 300)
+responses = LRUCache(1024, 300)
+increments = count(1)
+marker = compile_regex("\x00(\\d+)\x00")
+
+
+def renumber(text: str, marked: bool = True) -> str:
+    if "\x00" not in text:
+        return text
+    ids: dict[str, int] = {}
+
+    def replace(match: Match[str]) -> str:
+        if match[1] not in ids:
+            ids[match[1]] = next(increments)
+        return f"\x00{ids[match[1]]}\x00" if marked else str(ids[match[1]])
+
+    return marker.sub(replace, text)
+
+
+def unmark(text: str) -> str:
+    return marker.sub(r"\1", text) if "\x00" in text else text
+
+
+def render_markdown(text: str) -> str:
+    return markdown_cache.get_or_set(
+        sha256(text.encode()).digest(),
+        lambda: markdown(text, extensions=markdown_extensions),
+    )
+
+
+def eval_expression(ctx: dict[str, Any], source: str, code: Expression) -> Any:
+    try:
+        if isinstance(code, SyntaxError):
+            raise code
+        return eval(code, ctx)
+    except Exception as e:
+        print(source, " -> ", e)
+
+
+def eval_segments(
+    segments: list[tuple[bool, str]], **kwargs: Any
+) -> list[str | Any]:
+    return [
+        (
+            eval_expression(kwargs, value, expressions.compile(value))
+            if inside
+            else value
+        )
+        for inside, value in segments
+    ]
 
 
 def make_str(value: Any | None, encode: Encode = Encode.STR) -> str:
@@ -135,7 +251,7 @@ def make_str(value: Any | None, encode: Encode = Encode.STR) -> str:
         return ""
     result = str(value)
     if encode == Encode.URL:
-        result = quote(result)
+        result = quote(result, safe="")
     return result
 
 
@@ -150,10 +266,6 @@ def join_segments(
     )
 
 
-def fstr(value: str, **kwargs: Any) -> Any | str | None:
-    return join_segments(eval_segments(parse_segments(value), **kwargs))
-
-
 def join_query(**kwargs: Any) -> str:
     query = urlencode(kwargs).strip()
     return f"?{query}" if len(query) else ""
@@ -179,8 +291,14 @@ def generate_url(
     segments: list[tuple[bool, str]], names: list[str], **kwargs: Any
 ) -> str:
     ctx, query = split_known(names, **kwargs)
+    values = eval_segments(segments, **ctx)
     return make_str(
-        join_segments(eval_segments(segments, **ctx), Encode.URL)
+        join_segments(
+            [
+                make_str(value, Encode.URL) if inside else value
+                for (inside, _), value in zip(segments, values)
+            ]
+        )
     ) + join_query(**query)
 
 
@@ -240,12 +358,70 @@ def strip_path(path: str):
     return stripped if len(stripped) else "/"
 
 
+class Router:
+
+    def __init__(self, routes: list[tuple[str, str]]):
+        self.static: dict[str, tuple[int, str]] = {}
+        self.dynamic: dict[int, tuple[int, str, list[str]]] = {}
+        self.reverse: dict[str, tuple[list[tuple[bool, str]], list[str]]] = {}
+        self.size = len(routes)
+        self.first_dynamic = self.size
+        patterns: list[str] = []
+        group = 1
+        for index, (name, value) in enumerate(routes):
+            segments = parse_segments(value)
+            self.reverse.setdefault(name, (segments, extract_names(segments)))
+            value = strip_path(value)
+            segments = parse_segments(value)
+            names = extract_names(segments)
+            if not len(names):
+                self.static.setdefault(value, (index, name))
+                continue
+            pattern = ""
+            parts = iter(segments)
+            for inside, content in parts:
+                if not inside:
+                    pattern += escape(content)
+                elif following := next(parts, None):
+                    pattern += f"(?>(.*?){escape(following[1])})"
+                else:
+                    pattern += "(.*)"
+            patterns.append(f"({pattern}\\Z)")
+            self.dynamic[group] = (index, name, names)
+            self.first_dynamic = min(self.first_dynamic, index)
+            group += len(names) + 1
+        self.pattern = compile_regex("|".join(patterns) or "(?!)", DOTALL)
+
+    def match(self, path: str) -> tuple[str, dict[str, str]] | None:
+        index, name = self.static.get(path, (self.size, ""))
+        if self.first_dynamic < index and (found := self.pattern.match(path)):
+            group = found.lastindex or 0
+            dynamic, route, names = self.dynamic[group]
+            if dynamic < index:
+                return route, dict(
+                    zip(names, found.groups()[group : group + len(names)])
+                )
+        return (name, {}) if index < self.size else None
+
+
 class Server(ThreadingHTTPServer):
 
-    def start(self, fn: Callable[[], Any] | None = None):
+    def start(
+        self,
+        fn: Callable[[], Any] | None = None,
+        check: Callable[[], bool] | None = None,
+    ):
         parser = ArgumentParser()
         parser.add_argument("-o", action="store_true")
-        should_open_browser: bool = parser.parse_args().o
+        parser.add_argument("--check", action="store_true")
+        args = parser.parse_args()
+        should_open_browser: bool = args.o
+        if args.check:
+            ok = check() if check else True
+            self.server_close()
+            if fn:
+                fn()
+            exit(0 if ok else 1)
 
         url = f"http://{self.server_address[0]}:{self.server_address[1]}"
         print(f"Server running at {url}")
@@ -258,8 +434,12 @@ class Server(ThreadingHTTPServer):
                 fn()
             exit(0)
 
+    def shutdown_request(self, request: Any):
+        if not hub.owns(request):
+            super().shutdown_request(request)
+
 
-self_closing = [
+self_closing = {
     "area",
     "base",
     "br",
@@ -277,11 +457,79 @@ self_closing = [
     "track",
     "wbr",
     "include",
-]
+}
+
+
+token_attrs = {"class", "error", "result", "x-class", "x-error", "x-result"}
+token_prefixes = ("on:", "if:", "x-on:", "x-if:")
+
+
+def is_token_attr(name: str) -> bool:
+    return name in token_attrs or name.startswith(token_prefixes)
+
+
+def format_attr(
+    name: str, value: str | None, tokenized: bool | None = None
+) -> str:
+    value = value.strip() if value else None
+    if not value:
+        return name
+    if is_token_attr(name) if tokenized is None else tokenized:
+        new_token = True
+        tokens: list[str] = []
+        for inside, content in parse_segments(value):
+            if not inside:
+                new_token = content[-1].isspace()
+                chunks = content.split()
+                if len(chunks):
+                    first, *other = chunks
+                    if not len(tokens) or content[0].isspace():
+                        tokens.append(first)
+                    else:
+                        tokens[-1] += first
+                    tokens += other
+            elif new_token:
+                tokens.append("{" + content + "}")
+            else:
+                tokens[-1] += "{" + content + "}"
+        tokens.sort()
+        value = " ".join(tokens)
+    return f'{name}="{value}"'
+
+
+escape_map = {
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "'": "&#39;",
+}
+whitespace = compile_regex(r"\s+")
+preformatted = {"textarea", "pre"}
+
+
+def escape_text(text: str) -> str:
+    for char, entity in escape_map.items():
+        if char in text:
+            text = text.replace(char, entity)
+    return text
 
 
 class SimpleNode:
 
+    __slots__ = (
+        "tagName",
+        "nodeType",
+        "nodeValue",
+        "parentNode",
+        "firstChild",
+        "lastChild",
+        "previousSibling",
+        "nextSibling",
+        "attrs",
+        "childNodes",
+    )
+
     def __init__(
         self,
         nodeType: Literal[1, 3, 8, 9],
@@ -315,13 +563,18 @@ class SimpleNode:
         self.lastChild = node
         self.firstChild = self.childNodes[0]
 
-    def print(self, *, docType: bool = False, pretty: bool = False) -> str:
+    def print(
+        self,
+        *,
+        docType: bool = False,
+        pretty: bool = False,
+        depth: int | None = None,
+    ) -> str:
         if self.nodeType == Node.TEXT_NODE:
             text = (
                 self.nodeValue
-                if self.parentNode
-                and self.parentNode.tagName in ["textarea", "pre"]
-                else sub(r"\s+", " ", self.nodeValue, flags=MULTILINE)
+                if self.parentNode and self.parentNode.tagName in preformatted
+                else whitespace.sub(" ", self.nodeValue)
             )
             if not self.previousSibling:
                 text = text.lstrip()
@@ -331,67 +584,25 @@ class SimpleNode:
                 return ""
             if pretty:
                 return text
-            escape_map = {
-                "&": "&amp;",
-                "<": "&lt;",
-                ">": "&gt;",
-                '"': "&quot;",
-                "'": "&#39;",
-            }
-            return "".join(escape_map.get(ch, ch) for ch in text)
+            return escape_text(text)
         if self.nodeType == Node.COMMENT_NODE:
             return f"<!-- {self.nodeValue.strip()} -->" if pretty else ""
-        depth = 0
-        cur = self
         lines: list[str] = []
-        while cur.parentNode and cur.parentNode.nodeType != Node.DOCUMENT_NODE:
-            depth += 1
-            cur = cur.parentNode
+        if depth is None:
+            depth = 0
+            cur = self
+            while (
+                cur.parentNode and cur.parentNode.nodeType != Node.DOCUMENT_NODE
+            ):
+                depth += 1
+                cur = cur.parentNode
         if docType and self.tagName == "html":
             lines.append("<!DOCTYPE html>")
         if self.parentNode:
-            sorted_attrs = dict(sorted(self.attrs.items()))
-            attrs: list[str] = []
-            for name, value in sorted_attrs.items():
-                value = value.strip() if value else None
-                if value:
-                    if (
-                        name
-                        in [
-                            "class",
-                            "error",
-                            "result",
-                            "x-class",
-                            "x-error",
-                            "x-result",
-                        ]
-                        or name.startswith("on:")
-                        or name.startswith("if:")
-                        or name.startswith("x-on:")
-                        or name.startswith("x-if:")
-                    ):
-                        new_token = True
-                        tokens: list[str] = []
-                        for inside, content in parse_segments(value):
-                            if not inside:
-                                new_token = content[-1].isspace()
-                                chunks = content.split()
-                                if len(chunks):
-                                    first, *other = chunks
-                                    if not len(tokens) or content[0].isspace():
-                                        tokens.append(first)
-                                    else:
-                                        tokens[-1] += first
-                                    tokens += other
-                            elif new_token:
-                                tokens.append("{" + content + "}")
-                            else:
-                                tokens[-1] += "{" + content + "}"
-                        tokens.sort()
-                        value = " ".join(tokens)
-                    attrs.append(f'{name}="{value}"')
-                else:
-                    attrs.append(name)
+            attrs = [
+                format_attr(name, value)
+                for name, value in sorted(self.attrs.items())
+            ]
             line = (
                 f"<{self.tagName}{" " if len(attrs) else ""}{" ".join(attrs)}>"
             )
@@ -407,7 +618,13 @@ class SimpleNode:
             count = 0
             is_text = False
             for node in self.childNodes:
-                child = node.print(docType=docType, pretty=pretty)
+                child = node.print(
+                    docType=docType,
+                    pretty=pretty,
+                    depth=(
+                        0 if self.nodeType == Node.DOCUMENT_NODE else depth + 1
+                    ),
+                )
                 if child.strip():
                     count += 1
                     is_text = node.nodeType == Node.TEXT_NODE
@@ -488,111 +705,744 @@ class Parser(HTMLParser):
             )
 
 
-def tree(path: str, left: SimpleNode, right: SimpleNode, **kwargs: Any):
-    for node in right.childNodes:
-        if node.nodeType == Node.ELEMENT_NODE:
-            if node.tagName == "yes":
-                value = node.getAttribute("condition")
-                if value:
-                    value = fstr(value, **kwargs)
-                    if isinstance(value, str):
-                        value = kwargs.get(value)
+resolved: dict[tuple[str, str], str] = {}
+
+
+def resolve_path(root: str, name: str) -> str:
+    key = (root, name)
+    if key not in resolved:
+        resolved[key] = realpath(join(root, name))
+    return resolved[key]
+
+
+docs: dict[str, tuple[int, SimpleNode]] = {}
+
+
+def parse_html(root: str, name: str) -> tuple[str, SimpleNode]:
+    real = resolve_path(root, name + ".html")
+    with open(real) as f:
+        time = int(getmtime(f.fileno()))
+        if real not in docs or docs[real][0] != time:
+            docs[real] = (time, Parser().parse(f.read().strip()))
+    return real, docs[real][1]
+
+
+class Writer:
+
+    def __init__(self, *, docType: bool = False):
+        self.docType = docType
+        self.parts: list[str] = []
+        self.tags: list[str] = [""]
+        self.filled: list[bool] = [False]
+        self.pending: list[str] = []
+        self.pending_first = False
+        self.pieces: list[Any] | None = None
+        self.captured = 0
+
+    def text(self, value: str):
+        if len(value):
+            if not len(self.pending):
+                self.pending_first = not self.filled[-1]
+                self.filled[-1] = True
+            self.pending.append(value)
+
+    def flush(self, last: bool):
+        if not len(self.pending):
+            return
+        text = "".join(self.pending)
+        self.pending.clear()
+        if self.tags[-1] not in preformatted:
+            text = whitespace.sub(" ", text)
+        if self.pending_first:
+            text = text.lstrip()
+        if last:
+            text = text.rstrip()
+        if not text.isspace():
+            self.parts.append(escape_text(text))
+
+    def open(self, tagName: str, attrs: str):
+        self.flush(False)
+        self.filled[-1] = True
+        if self.docType and tagName == "html":
+            self.parts.append("<!DOCTYPE html>")
+        self.parts.append(f"<{tagName}{" " if len(attrs) else ""}{attrs}>")
+        if tagName not in self_closing:
+            self.tags.append(tagName)
+            self.filled.append(False)
+
+    def close(self):
+        self.flush(True)
+        self.filled.pop()
+        self.parts.append(f"</{self.tags.pop()}>")
+
+    def raw(self, value: str):
+        self.flush(False)
+        self.filled[-1] = True
+        if len(value):
+            self.parts.append(value)
+
+    def begin(self):
+        self.raw("")
+        self.tags.append(self.tags[-1])
+        self.filled.append(False)
+
+    def end(self):
+        self.flush(True)
+        self.tags.pop()
+        self.filled.pop()
+
+    def capture(self) -> list[str]:
+        self.begin()
+        self.captured += 1
+        parts, self.parts = self.parts, []
+        return parts
+
+    def release(self, parts: list[str]) -> str:
+        self.end()
+        self.captured -= 1
+        value = "".join(self.parts)
+        self.parts = parts
+        self.raw(value)
+        return value
+
+    def drain(self) -> str:
+        value = "".join(self.parts)
+        self.parts.clear()
+        return value
+
+    def getvalue(self) -> str:
+        self.flush(True)
+        return self.drain()
+
+
+class Scope(dict[str, Any]):
+
+    def __init__(self, values: dict[str, Any], parent: "Scope | None" = None):
+        super().__init__(values)
+        self.parent = parent
+
+    def __missing__(self, key: str) -> Any:
+        if self.parent is None:
+            raise KeyError(key)
+        return self.parent[key]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+Render = Callable[[Writer, Scope], Iterator[None]]
+Hole = tuple[Render, list[dict[str, Any]]]
+
+
+CompiledSegments = list[tuple[str, Expression | None]]
+
+
+def render_value(ctx: Scope, segments: CompiledSegments):
+    return join_segments(
+        [
+            value if code is None else eval_expression(ctx, value, code)
+            for value, code in segments
+        ]
+    )
+
+
+def render_condition(ctx: Scope, segments: CompiledSegments):
+    value = render_value(ctx, segments)
+    return ctx.get(value) if isinstance(value, str) else value
+
+
+def render_loop(ctx: Scope, segments: CompiledSegments):
+    value = render_condition(ctx, segments)
+    if isinstance(value, (list, set)):
+        lst: Iterable[Any] = value  # type: ignore
+        for index, item in enumerate(lst):  # type: ignore
+            yield Scope(
+                {**asdict(item), "i": index, "item": item, "items": value},
+                ctx,
+            )
+
+
+def render_include(
+    w: Writer,
+    root: str,
+    ctx: Scope,
+    segments: CompiledSegments,
+    attrs: list[tuple[str, CompiledSegments | str | None]],
+) -> Iterator[None]:
+    value = render_value(ctx, segments)
+    if isinstance(value, str):
+        _, render = compile_html(root, value)
+        yield from render(
+            w,
+            Scope(
+                dict(
+                    (name, render_value(ctx, x) if isinstance(x, list) else x)
+                    for name, x in attrs
+                ),
+                ctx,
+            ),
+        )
+
+
+def render_cache(
+    w: Writer,
+    ctx: Scope,
+    name: str,
+    segments: CompiledSegments,
+    ttl: float | None,
+    fn: Callable[[], Iterator[None]],
+):
+    key = (name, make_str(render_value(ctx, segments)))
+    value = fragments.get(key, missing)
+    if value is missing:
+        parts = w.capture()
+        for _ in fn():
+            pass
+        fragments.set(key, w.release(parts), ttl)
+    else:
+        value = renumber(value)
+        w.raw(value)
+        ids = marker.findall(value)
+        root = ctx
+        while root.parent is not None:
+            root = root.parent
+        if ids and isinstance(root, Context):
+            root.handler.increment = int(ids[-1])
+    yield
+
+
+def render_personal(w: Writer, ctx: Scope, fn: Render) -> Iterator[None]:
+    if w.captured:
+        raise ValueError("<personal> cannot be rendered inside <cache>")
+    if w.pieces is None:
+        w.begin()
+        yield from fn(w, ctx)
+        w.end()
+    else:
+        w.begin()
+        w.end()
+        layers: list[dict[str, Any]] = []
+        scope: Scope | None = ctx
+        while scope is not None and not isinstance(scope, Context):
+            layers.append(dict(scope))
+            scope = scope.parent
+        w.pieces.append(w.drain())
+        w.pieces.append((fn, layers[::-1]))
+    yield
+
+
+def render_attr(
+    ctx: Scope, name: str, segments: CompiledSegments, tokenized: bool
+) -> str | None:
+    value = render_value(ctx, segments)
+    if isinstance(value, str) or value:
+        return format_attr(
+            name, None if isinstance(value, bool) else str(value), tokenized
+        )
+
+
+def join_attrs(attrs: Iterable[str | None]) -> str:
+    return " ".join(x for x in attrs if x is not None)
+
+
+def is_static(value: str) -> bool:
+    return not any(inside for inside, _ in parse_segments(value))
+
+
+def compile_template(real: str, mtime: int, xml: SimpleNode) -> Render:
+    root = dirname(real)
+    namespace: dict[str, Any] = {
+        "make_str": make_str,
+        "render_value": render_value,
+        "render_condition": render_condition,
+        "render_loop": render_loop,
+        "render_include": render_include,
+        "render_cache": render_cache,
+        "render_personal": render_personal,
+        "render_attr": render_attr,
+        "join_attrs": join_attrs,
+    }
+    lines: list[str] = []
+
+    def segments(value: str) -> CompiledSegments:
+        return [
+            (x, expressions.compile(x, real, mtime) if inside else None)
+            for inside, x in parse_segments(value)
+        ]
+
+    def constant(value: Any) -> str:
+        name = f"K{len(namespace)}"
+        namespace[name] = value
+        return name
+
+    def emit(node: SimpleNode, depth: int, indent: str):
+        start = len(lines)
+        ctx = f"ctx{depth}"
+        for child in node.childNodes:
+            if child.nodeType == Node.TEXT_NODE:
+                if is_static(child.nodeValue):
+                    lines.append(f"{indent}w.text({child.nodeValue!r})")
+                else:
+                    lines.append(
+                        f"{indent}w.text(make_str(render_value({ctx}, {
+                            constant(segments(child.nodeValue))})))"
+                    )
+            elif child.nodeType != Node.ELEMENT_NODE:
+                continue
+            elif child.tagName in ["yes", "no"]:
+                value = child.getAttribute("condition")
+                negate = "not " if child.tagName == "no" else ""
                 if value:
-                    tree(path, left, node, **kwargs)
-            elif node.tagName == "no":
-                value = node.getAttribute("condition")
+                    lines.append(f"{indent}yield")
+                    lines.append(
+                        f"{indent}if {negate}render_condition({ctx}, {
+                            constant(segments(value))}):"
+                    )
+                    emit(child, depth, indent + "    ")
+                elif negate:
+                    emit(child, depth, indent)
+            elif child.tagName == "for":
+                value = child.getAttribute("collection")
                 if value:
-                    value = fstr(value, **kwargs)
-                    if isinstance(value, str):
-                        value = kwargs.get(value)
-                if not value:
-                    tree(path, left, node, **kwargs)
-            elif node.tagName == "for":
-                value = node.getAttribute("collection")
+                    lines.append(f"{indent}yield")
+                    lines.append(
+                        f"{indent}for ctx{depth + 1} in render_loop({ctx}, {
+                            constant(segments(value))}):"
+                    )
+                    emit(child, depth + 1, indent + "    ")
+                    lines.append(f"{indent}    yield")
+            elif child.tagName == "cache":
+                value = child.getAttribute("key")
                 if value:
-                    value = fstr(value, **kwargs)
-                    if isinstance(value, str):
-                        value = kwargs.get(value)
-                if isinstance(value, (list, set)):
-                    lst: Iterable[Any] = value  # type: ignore
-                    for index, item in enumerate(lst):  # type: ignore
-                        tree(
-                            path,
-                            left,
-                            node,
-                            **{
-                                **kwargs,
-                                **asdict(item),
-                                "i": index,
-                                "item": item,
-                                "items": value,
-                            },
+                    ttl = child.getAttribute("ttl")
+                    try:
+                        expires = float(ttl) if ttl else None
+                    except ValueError:
+                        raise ValueError(
+                            f"{real}: <cache ttl={ttl!r}> is not a number"
+                        ) from None
+                    name = constant(segments(value))
+                    key = f"{real}:{mtime}:{name}"
+                    lines.append(f"{indent}yield")
+                    lines.append(f"{indent}def {name.lower()}():")
+                    emit(child, depth, indent + "    ")
+                    lines.append(f"{indent}    yield")
+                    lines.append(
+                        f"{indent}yield from render_cache(w, {ctx}, {key!r}, {
+                            name}, {expires!r}, {name.lower()})"
+                    )
+                else:
+                    emit(child, depth, indent)
+            elif child.tagName == "personal":
+                parent = child.parentNode
+                while parent:
+                    if parent.tagName == "cache" and parent.getAttribute("key"):
+                        raise ValueError(
+                            f"{real}: <personal> cannot be nested in <cache>"
                         )
-            elif node.tagName == "include":
-                value = node.getAttribute("tpl")
+                    parent = parent.parentNode
+                name = f"p{len(lines)}"
+                lines.append(f"{indent}yield")
+                lines.append(f"{indent}def {name}(w, {ctx}):")
+                emit(child, depth, indent + "    ")
+                lines.append(f"{indent}    yield")
+                lines.append(
+                    f"{indent}yield from render_personal(w, {ctx}, {name})"
+                )
+            elif child.tagName == "include":
+                value = child.getAttribute("tpl")
                 if value:
-                    value = fstr(value, **kwargs)
-                if isinstance(value, str):
-                    real, xml = parse_html(path, value)
-                    ctx: dict[str, Any] = {}
-                    for attr, value in node.attrs.items():
-                        if attr == "tpl":
-                            continue
-                        if value:
-                            value = fstr(value, **kwargs)
-                        ctx[attr] = value
-                    tree(real, left, xml, **{**kwargs, **ctx})
+                    include_attrs = [
+                        (name, segments(x) if x else x)
+                        for name, x in child.attrs.items()
+                        if name != "tpl"
+                    ]
+                    lines.append(f"{indent}yield")
+                    lines.append(
+                        f"{indent}yield from render_include(w, {
+                            root!r}, {ctx}, {constant(segments(value))}, {
+                            constant(include_attrs)})"
+                    )
             else:
-                element = SimpleNode(Node.ELEMENT_NODE, tagName=node.tagName)
-                for attr, value in node.attrs.items():
-                    if value:
-                        value = fstr(value, **kwargs)
-                        if isinstance(value, str) or value:
-                            element.setAttribute(
-                                attr,
-                                None if isinstance(value, bool) else str(value),
-                            )
+                static: list[str] = []
+                attrs: list[str] = []
+                for name, value in sorted(child.attrs.items()):
+                    if not value or is_static(value):
+                        static.append(format_attr(name, value))
+                        attrs.append(repr(static[-1]))
                     else:
-                        element.setAttribute(attr, value)
-                tree(path, element, node, **kwargs)
-                left.appendChild(element)
-        elif node.nodeType == Node.TEXT_NODE:
-            value = make_str(fstr(node.nodeValue, **kwargs))
-            if len(value):
-                last = left.lastChild
-                if last and last.nodeType == Node.TEXT_NODE:
-                    last.nodeValue += value
+                        attrs.append(
+                            f"render_attr({ctx}, {name!r}, {
+                                constant(segments(value))}, {
+                                is_token_attr(name)})"
+                        )
+                lines.append(
+                    f"{indent}w.open({child.tagName!r}, {
+                        repr(" ".join(static))
+                        if len(static) == len(attrs)
+                        else f"join_attrs(({", ".join(attrs)},))"
+                    })"
+                )
+                if child.tagName not in self_closing:
+                    emit(child, depth, indent)
+                    lines.append(f"{indent}w.close()")
+        if len(lines) == start:
+            lines.append(f"{indent}pass")
+
+    emit(xml, 0, "    ")
+    source = "\n".join(["def render(w, ctx0):", *lines, "    yield"])
+    exec(compile(source, real, "exec"), namespace)
+    return namespace["render"]
+
+
+templates: dict[str, tuple[SimpleNode, Render]] = {}
+
+
+def compile_html(root: str, name: str) -> tuple[str, Render]:
+    real, xml = parse_html(root, name)
+    if real not in templates or templates[real][0] is not xml:
+        templates[real] = (xml, compile_template(real, docs[real][0], xml))
+    return real, templates[real][1]
+
+
+class Context(Scope):
+
+    def __init__(
+        self,
+        handler: "BaseHandler",
+        defaults: dict[str, Any],
+        values: dict[str, Any],
+    ):
+        super().__init__(values)
+        self.handler = handler
+        self.defaults = defaults
+
+    def __missing__(self, key: str) -> Any:
+        cache = self.handler.context_cache
+        if key not in cache and hasattr(type(self.handler), f"ctx_{key}"):
+            cache[key] = getattr(self.handler, f"ctx_{key}")
+        value = cache[key] if key in cache else self.defaults[key]
+        self[key] = value
+        return value
+
+
+def iterate_async(values: AsyncIterable[T]) -> Iterator[T]:
+    loop = new_event_loop()
+    iterator = aiter(values)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(anext(iterator))
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+STREAM_DELIMITER = "<!-- keml -->"
+
+
+def delimit_parts(parts: Iterable[str | Iterable[str]]) -> Iterator[str]:
+    for i, part in enumerate(parts):
+        if i:
+            yield STREAM_DELIMITER
+        if isinstance(part, str):
+            yield part
+        else:
+            yield from part
+
+
+def encode_sse(event: str, data: str | None, id: str | None = None) -> bytes:
+    lines = (
+        [f"event: {event}"] if id is None else [f"id: {id}", f"event: {event}"]
+    )
+    lines.extend(f"data: {line}" for line in split(r"\r\n|\r|\n", f"{data}"))
+    lines.append("\n")
+    return "\n".join(lines).encode()
+
+
+connected_frame = memoryview(b": connected\n\n")
+ping_frame = memoryview(b": ping\n\n")
+
+
+class SseClient:
+
+    def __init__(self, path: str, sock: socket):
+        self.path = path
+        self.sock = sock
+        self.queue: deque[memoryview] = deque()
+        self.events = 0
+        self.slot = 0
+        self.scheduled = False
+        self.evicted = False
+        self.closed = False
+
+
+class SseChannel:
+
+    def __init__(self, history: int):
+        self.lock = Lock()
+        self.clients: set[SseClient] = set()
+        self.history: deque[tuple[str, memoryview]] = deque(maxlen=history)
+        self.sequence = 0
+        self.idle: float | None = None
+
+    def replay(self, last_id: str) -> list[memoryview]:
+        for i, (id, _) in enumerate(self.history):
+            if id == last_id:
+                return [frame for _, frame in islice(self.history, i + 1, None)]
+        return []
+
+
+class SseRegistry:
+
+    def __init__(
+        self, shards: int = 16, history: int = 128, retention: float = 60
+    ):
+        self.history = history
+        self.retention = retention
+        self.shards: list[tuple[Lock, dict[str, SseChannel]]] = [
+            (Lock(), {}) for _ in range(shards)
+        ]
+
+    def shard(self, path: str) -> tuple[Lock, dict[str, SseChannel]]:
+        return self.shards[hash(path) % len(self.shards)]
+
+    def channel(self, path: str) -> SseChannel | None:
+        return self.shard(path)[1].get(path)
+
+    def join(self, client: SseClient, last_id: str | None):
+        lock, channels = self.shard(client.path)
+        with lock:
+            channel = channels.get(client.path)
+            if channel is None:
+                channel = channels[client.path] = SseChannel(self.history)
+            with channel.lock:
+                if last_id:
+                    client.queue.extend(channel.replay(last_id))
+                channel.clients.add(client)
+                channel.idle = None
+
+    def discard(self, client: SseClient):
+        lock, channels = self.shard(client.path)
+        with lock:
+            channel = channels.get(client.path)
+            if channel is not None:
+                with channel.lock:
+                    channel.clients.discard(client)
+                    if not channel.clients:
+                        if channel.history:
+                            channel.idle = monotonic()
+                        else:
+                            del channels[client.path]
+
+    def expire(self):
+        deadline = monotonic() - self.retention
+        for lock, channels in self.shards:
+            with lock:
+                for path, channel in list(channels.items()):
+                    if channel.idle is not None and channel.idle < deadline:
+                        del channels[path]
+
+    def count(self, path: str) -> int:
+        channel = self.channel(path)
+        return len(channel.clients) if channel else 0
+
+    def counts(self) -> dict[str, int]:
+        return {
+            path: len(channel.clients)
+            for _, channels in self.shards
+            for path, channel in list(channels.items())
+        }
+
+
+class SseHub:
+
+    def __init__(self, max_queue: int = 256, ping_interval: int = 15):
+        self.max_queue = max_queue
+        self.epoch = f"{int(time()):x}"
+        self.registry = SseRegistry()
+        self.sockets: dict[socket, SseClient] = {}
+        self.pending: deque[SseClient] = deque()
+        self.lock = Lock()
+        self.wheel: list[set[SseClient]] = [set() for _ in range(ping_interval)]
+        self.cursor = 0
+        self.selector = DefaultSelector()
+        self.waker, self.wakee = socketpair()
+        self.thread: Thread | None = None
+
+    def owns(self, sock: socket) -> bool:
+        return sock in self.sockets
+
+    def count(self, path: str) -> int:
+        return self.registry.count(path)
+
+    def counts(self) -> dict[str, int]:
+        return self.registry.counts()
+
+    def subscribe(self, path: str, sock: socket, last_id: str | None = None):
+        client = SseClient(path, sock)
+        client.queue.append(connected_frame)
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = Thread(target=self.run, daemon=True)
+                    self.thread.start()
+        self.sockets[sock] = client
+        self.registry.join(client, last_id)
+        self.schedule(client)
+        self.wake()
+
+    def publish(
+        self, path: str, event: str, data: str | None, id: str | None = None
+    ):
+        channel = self.registry.channel(path)
+        if channel is None:
+            return
+        with channel.lock:
+            if id is None:
+                channel.sequence += 1
+                id = f"{self.epoch}-{channel.sequence}"
+            view = memoryview(encode_sse(event, data, id))
+            channel.history.append((id, view))
+            for client in channel.clients:
+                if len(client.queue) < self.max_queue:
+                    client.queue.append(view)
                 else:
-                    left.appendChild(
-                        SimpleNode(Node.TEXT_NODE, nodeValue=value)
-                    )
+                    client.evicted = True
+                self.schedule(client)
+        self.wake()
 
+    def schedule(self, client: SseClient):
+        if not client.scheduled:
+            client.scheduled = True
+            self.pending.append(client)
 
-docs: dict[str, tuple[int, SimpleNode]] = {}
+    def wake(self):
+        try:
+            self.waker.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def run(self):
+        self.waker.setblocking(False)
+        self.wakee.setblocking(False)
+        self.selector.register(self.wakee, EVENT_READ)
+        deadline = monotonic() + 1
+        while True:
+            for key, events in self.selector.select(
+                max(0, deadline - monotonic())
+            ):
+                if key.data is None:
+                    try:
+                        while self.wakee.recv(4096):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    continue
+                if events & EVENT_READ:
+                    self.receive(key.data)
+                if events & EVENT_WRITE:
+                    self.flush(key.data)
+            while self.pending:
+                client = self.pending.popleft()
+                client.scheduled = False
+                self.flush(client)
+            if monotonic() >= deadline:
+                deadline = monotonic() + 1
+                self.tick()
+
+    def tick(self):
+        for client in list(self.wheel[self.cursor]):
+            if not client.queue:
+                client.queue.append(ping_frame)
+                self.flush(client)
+        self.cursor = (self.cursor + 1) % len(self.wheel)
+        if not self.cursor:
+            self.registry.expire()
+
+    def receive(self, client: SseClient):
+        try:
+            if client.sock.recv(4096):
+                return
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            pass
+        self.drop(client)
 
+    def flush(self, client: SseClient):
+        if client.closed:
+            return
+        if client.evicted:
+            return self.drop(client)
+        if not client.events:
+            client.sock.setblocking(False)
+            client.slot = (self.cursor - 1) % len(self.wheel)
+            self.wheel[client.slot].add(client)
+        try:
+            while client.queue:
+                view = client.queue[0]
+                sent = client.sock.send(view)
+                if sent < len(view):
+                    client.queue[0] = view[sent:]
+                    break
+                client.queue.popleft()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            return self.drop(client)
+        events = EVENT_READ | EVENT_WRITE if client.queue else EVENT_READ
+        if client.events != events:
+            if client.events:
+                self.selector.modify(client.sock, events, client)
+            else:
+                self.selector.register(client.sock, events, client)
+            client.events = events
 
-def parse_html(path: str, name: str) -> tuple[str, SimpleNode]:
-    real = realpath(join(dirname(path), name + ".html"))
-    with open(real) as f:
-        time = int(getmtime(f.fileno()))
-        if real not in docs or docs[real][0] != time:
-            docs[real] = (time, Parser().parse(f.read().strip()))
-    return real, docs[real][1]
+    def drop(self, client: SseClient):
+        if client.closed:
+            return
+        client.closed = True
+        self.registry.discard(client)
+        self.sockets.pop(client.sock, None)
+        self.wheel[client.slot].discard(client)
+        if client.events:
+            self.selector.unregister(client.sock)
+        try:
+            client.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        client.sock.close()
 
 
-increment = 0
-clients: dict[str, list[BaseHandler]] = {}
-clients_lock = Lock()
+hub = SseHub()
 
 
 class BaseHandler(BaseHTTPRequestHandler):
 
+    protocol_version = "HTTP/1.1"
+
     SECRET = ""
 
     DATETIME_FORMAT = "%c"
 
     ROUTES: list[tuple[str, str]] = []
 
+    root = ""
+
+    router = Router(ROUTES)
+
+    def __init_subclass__(cls, **kwargs: Any):
+        super().__init_subclass__(**kwargs)
+        cls.router = Router(cls.ROUTES)
+        if "root" not in cls.__dict__:
+            cls.root = dirname(realpath(modules[cls.__module__].__file__ or ""))
+
     def log_message(self, format: str, *args: Any):
         super().log_message(f"{format} {" -> ".join(self.method_msg)}", *args)
 
@@ -609,6 +1459,21 @@ class BaseHandler(BaseHTTPRequestHandler):
         self.user = None
         self.active_route = None
         self.method_msg: list[str] = []
+        self.context_cache: dict[str, Any] = {}
+        self.identity_map: dict[tuple[Any, ...], Any] = {}
+        self.recording: list[bytes] | None = None
+        self.recorded: tuple[int, list[tuple[str, str]]] | None = None
+        self.marked = False
+        self.increment = 0
+        content_type = self.headers.get("Content-Type") or ""
+        if (
+            self.headers.get("Content-Length", "0") != "0"
+            or "Transfer-Encoding" in self.headers
+        ) and not (
+            self.command == "POST"
+            and content_type.startswith("multipart/form-data")
+        ):
+            self.response_headers.append(("Connection", "close"))
         token = self.parsed_cookies.get("jwt")
         if token:
             try:
@@ -651,64 +1516,108 @@ class BaseHandler(BaseHTTPRequestHandler):
     def set_user(self, user_id: int):
         self.user = None
 
+    def identity(self, key: tuple[Any, ...], fn: Callable[[], T]) -> T:
+        if key not in self.identity_map:
+            self.identity_map[key] = fn()
+        return self.identity_map[key]
+
     def handle_sse(self):
-        with clients_lock:
-            clients.setdefault(self.parsed_path, []).append(self)
-        try:
-            self.wfile.write(b": connected\n\n")
-            self.wfile.flush()
-            while True:
-                self.wfile.write(b": ping\n\n")
-                self.wfile.flush()
-                sleep(15)
-        except (BrokenPipeError, ConnectionResetError, OSError) as e:
-            if e.winerror != 10038:
-                print("Unexpected SSE error:", format_exc())
-        except Exception:
-            print("Unexpected SSE error:", format_exc())
-        finally:
-            with clients_lock:
-                if self in clients.setdefault(self.parsed_path, []):
-                    clients[self.parsed_path].remove(self)
-
-    def send_status(self, status: int = 200):
+        self.close_connection = True
+        hub.subscribe(
+            self.parsed_path, self.connection, self.headers.get("Last-Event-ID")
+        )
+
+    def send_status(self, status: int = 200, length: int | None = 0):
         self.send_response(status)
         for name, value in self.response_headers:
             self.send_header(name, value)
+        if length is not None:
+            self.send_header("Content-Length", str(length))
         self.end_headers()
         self.status_sent = True
+        if self.recording is not None:
+            self.recorded = (
+                status,
+                [
+                    x
+                    for x in self.response_headers
+                    if x[0] not in ["Transfer-Encoding", "Connection"]
+                ],
+            )
 
     def send_bytes(self, data: bytes, status: int = 200):
-        self.send_status(status)
+        self.send_status(status, len(data))
         self.wfile.write(data)
+        if self.recording is not None:
+            self.recording.append(data)
 
-    def send_sse_string(self, path: str, event: str, data: str | None):
-        with clients_lock:
-            for client in clients.setdefault(path, [])[:]:
-                try:
-                    client.wfile.write(f"event: {event}\n".encode())
-                    client.wfile.write(f"data: {data}\n\n".encode())
-                    client.wfile.flush()
-                except Exception:
-                    clients[path].remove(client)
+    def send_sse_string(
+        self, path: str, event: str, data: str | None, id: str | None = None
+    ):
+        hub.publish(path, event, data, id)
 
     def send_string(self, data: str, status: int = 200):
-        self.send_bytes(data.encode(), status)
+        self.send_strings([data], status)
 
     def send_strings(self, data: list[str], status: int = 200):
-        self.send_status(status)
-        for msg in data:
-            self.wfile.write(msg.encode())
+        if self.recording is not None:
+            self.recording.extend(msg.encode() for msg in data)
+            self.marked = True
+        chunks = [unmark(msg).encode() for msg in data]
+        self.send_status(status, sum(len(chunk) for chunk in chunks))
+        for chunk in chunks:
+            self.wfile.write(chunk)
+
+    def send_chunks(self, data: Iterable[str], status: int = 200):
+        chunked = self.request_version == "HTTP/1.1"
+        if chunked:
+            self.response_headers.append(("Transfer-Encoding", "chunked"))
+        else:
+            self.response_headers.append(("Connection", "close"))
+        self.send_status(status, None)
+        try:
+            for msg in data:
+                if self.recording is not None:
+                    self.recording.append(msg.encode())
+                    self.marked = True
+                chunk = unmark(msg).encode()
+                if chunked:
+                    chunk = f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n"
+                self.wfile.write(chunk)
+                self.wfile.flush()
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            self.recorded = None
+
+    def send_stream(
+        self,
+        parts: (
+            Iterable[str | Iterable[str]] | AsyncIterable[str | Iterable[str]]
+        ),
+        status: int = 200,
+    ):
+        self.send_chunks(
+            delimit_parts(
+                iterate_async(parts)
+                if isinstance(parts, AsyncIterable)
+                else parts
+            ),
+            status,
+        )
 
     def send_tpl(self, name: str, status: int = 200, **kwargs: Any):
         self.send_string(self.tpl(name, **kwargs), status)
 
+    def send_tpl_stream(self, name: str, status: int = 200, **kwargs: Any):
+        self.send_chunks(self.tpl_stream(name, **kwargs), status)
+
     def send_sse_tpl(self, path: str, event: str, name: str, **kwargs: Any):
-        self.send_sse_string(path, event, self.tpl(name, **kwargs))
+        self.send_sse_string(path, event, unmark(self.tpl(name, **kwargs)))
 
     def send_file(self, name: str):
-        real = realpath(join(dirname(resolve_filename()), name))
-        with open(real, "rb") as f:
+        with open(resolve_path(self.root, name), "rb") as f:
             self.send_bytes(f.read())
 
     def single_parsed_data(self, name: str):
@@ -733,35 +1642,72 @@ class BaseHandler(BaseHTTPRequestHandler):
             if attr:
                 self.method_msg.append(method)
                 attr()
+                sse = self.parsed_path.endswith(".sse")
                 if not self.status_sent:
-                    self.send_status(status)
-                if self.parsed_path.endswith(".sse"):
-                    Thread(target=self.handle_sse, daemon=True).start()
+                    self.send_status(status, None if sse else 0)
+                if sse:
+                    self.handle_sse()
                 return True
             self.method_msg.append(f"{method}(missing)")
         return False
 
+    def response_key(self) -> Any:
+        return None
+
+    def execute_cached(self, verb: str, name: str) -> bool:
+        key = (
+            self.response_key()
+            if verb == "get"
+            and not self.user
+            and not self.parsed_path.endswith(".sse")
+            else None
+        )
+        if key is None:
+            return self.execute_method(verb, name)
+        tzo = self.parsed_cookies.get("tzo")
+        key = (
+            self.parsed_path,
+            self.path.partition("?")[2],
+            self.is_xhr,
+            tzo.value if tzo else None,
+            key,
+        )
+        cached = responses.get(key)
+        if cached:
+            status, headers, body, marked = cached
+            self.response_headers = list(headers)
+            self.method_msg.append("cached")
+            if marked:
+                body = renumber(body.decode(), False).encode()
+            self.send_bytes(body, status)
+            return True
+        self.recording = []
+        found = self.execute_method(verb, name)
+        if (
+            found
+            and self.recorded
+            and self.recorded[0] < 500
+            and all(x[0] != "Set-Cookie" for x in self.recorded[1])
+        ):
+            responses.set(
+                key, (*self.recorded, b"".join(self.recording), self.marked)
+            )
+        self.recording = None
+        return found
+
     def match_path(self, verb: str):
-        for name, value in self.ROUTES:
-            value = strip_path(value)
-            segments = parse_segments(value)
-            matches = match_segments(value, self.parsed_path, segments)
-            if matches is not None:
-                self.parsed_params = matches
-                self.active_route = name
-                if self.execute_method(verb, name):
-                    return
-                break
+        match = self.router.match(self.parsed_path)
+        if match:
+            self.active_route, self.parsed_params = match
+            if self.execute_cached(verb, self.active_route):
+                return
         self.execute_method(verb, "404", 404)
         if not self.status_sent:
             self.send_status(404)
 
     def url(self, route: str, **kwargs: Any) -> str:
-        for name, value in self.ROUTES:
-            if route == name:
-                segments = parse_segments(value)
-                return generate_url(segments, extract_names(segments), **kwargs)
-        return ""
+        reverse = self.router.reverse.get(route)
+        return generate_url(*reverse, **kwargs) if reverse else ""
 
     def ftime(self, time: int, format: str | None = None):
         offset = self.parsed_cookies.get("tzo")
@@ -776,34 +1722,82 @@ class BaseHandler(BaseHTTPRequestHandler):
         )
 
     def ctx_increment(self, inc: int = 0):
-        global increment
-        increment += inc
-        return increment
+        if inc:
+            self.increment = next(increments)
+        return f"\x00{self.increment}\x00"
 
-    def tpl(self, name: str, **kwargs: Any) -> str:
-        doc = SimpleNode(Node.DOCUMENT_NODE)
-        real, xml = parse_html(resolve_filename(), name)
-        tree(
-            real,
-            doc,
-            xml,
-            **{
+    def skeleton_key(self) -> Any:
+        return None
+
+    def context(self, kwargs: dict[str, Any]) -> Context:
+        return Context(
+            self,
+            {
                 "ceil": ceil,
-                "markdown": markdown,
+                "markdown": render_markdown,
                 "url": self.url,
                 "ftime": self.ftime,
                 "time": lambda: int(time()),
                 "user": self.user,
                 "active_route": self.active_route,
-                **dict(
-                    (x[4:], getattr(self, x))
-                    for x in dir(self)
-                    if x.startswith("ctx_")
-                ),
-                **kwargs,
             },
+            kwargs,
+        )
+
+    def render(self, w: Writer, name: str, **kwargs: Any) -> Iterator[None]:
+        key = self.skeleton_key()
+        if key is None:
+            _, render = compile_html(self.root, name)
+            return render(w, self.context(kwargs))
+        pieces: list[str | Hole] = skeletons.get_or_set(
+            (name, w.docType, key),
+            lambda: self.render_skeleton(w.docType, name, kwargs),
         )
-        return doc.print(docType=True)
+        return self.render_pieces(w, pieces, kwargs)
+
+    def render_skeleton(
+        self, docType: bool, name: str, kwargs: dict[str, Any]
+    ) -> list[str | Hole]:
+        w = Writer(docType=docType)
+        w.pieces = []
+        _, render = compile_html(self.root, name)
+        for _ in render(w, self.context(kwargs)):
+            pass
+        w.pieces.append(w.getvalue())
+        return w.pieces
+
+    def render_pieces(
+        self, w: Writer, pieces: list[str | Hole], kwargs: dict[str, Any]
+    ) -> Iterator[None]:
+        ctx: Scope | None = None
+        for piece in pieces:
+            if isinstance(piece, str):
+                w.raw(renumber(piece))
+            else:
+                fn, layers = piece
+                if ctx is None:
+                    ctx = self.context(kwargs)
+                scope = ctx
+                for layer in layers:
+                    scope = Scope(layer, scope)
+                w.begin()
+                yield from fn(w, scope)
+                w.end()
+            yield
+
+    def tpl(self, name: str, **kwargs: Any) -> str:
+        w = Writer(docType=True)
+        for _ in self.render(w, name, **kwargs):
+            pass
+        return w.getvalue()
+
+    def tpl_stream(self, name: str, **kwargs: Any) -> Iterator[str]:
+        w = Writer(docType=True)
+        for _ in self.render(w, name, **kwargs):
+            if chunk := w.drain():
+                yield chunk
+        if chunk := w.getvalue():
+            yield chunk
 
     def parse_multipart(self, content_type: str):
         clh = self.headers.get("Content-Length")
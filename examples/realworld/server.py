@@ -1,28 +1,144 @@
 from ..common import (
     BaseHandler,
+    LRUCache,
     Server,
     asdict,
+    fragments,
     generate_gravatar_url,
     generate_slug,
     get_one,
     hash_password,
+    markdown_version,
+    render_markdown,
     split_commas,
 )
-from typing import Any, NamedTuple
-from sqlite3 import connect
+from typing import Any, Callable, Generator, NamedTuple, TypeVar
+from sqlite3 import Connection, Cursor, connect
+from contextlib import contextmanager
+from functools import cache, wraps
 from os.path import dirname, join
+from queue import Empty, SimpleQueue
+from threading import Lock, local
 from time import time
 from urllib.parse import unquote
 
 
-connection = connect(join(dirname(__file__), "database.db"))
-commit = connection.commit
-cursor = connection.cursor()
-execute = cursor.execute
-executemany = cursor.executemany
-
+class Database:
+
+    def __init__(self, path: str, size: int = 16, cached_statements: int = 256):
+        self.path = path
+        self.size = size
+        self.cached_statements = cached_statements
+        self.executions = 0
+        self.prepares = 0
+        self.statements: set[str] = set()
+        self.prepared: dict[Connection, set[str]] = {}
+        self.versions: dict[str, int] = {}
+        self.idle: SimpleQueue[Connection] = SimpleQueue()
+        self.local = local()
+        self.writer = self.open()
+        self.writer.execute("PRAGMA journal_mode = WAL")
+        self.write_lock = Lock()
+
+    def open(self) -> Connection:
+        connection = connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=self.cached_statements,
+        )
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA busy_timeout = 5000")
+        connection.execute("PRAGMA mmap_size = 268435456")
+        connection.execute("PRAGMA cache_size = -16384")
+        self.prepared[connection] = set()
+        return connection
 
-execute(
+    @property
+    def cursor(self) -> Cursor:
+        cursor: Cursor | None = getattr(self.local, "cursor", None)
+        if cursor is None:
+            try:
+                connection = self.idle.get_nowait()
+            except Empty:
+                connection = self.open()
+            cursor = self.local.cursor = connection.cursor()
+        return cursor
+
+    def execute(self, sql: str, args: Any = ()) -> Cursor:
+        cursor = self.cursor
+        prepared = self.prepared[cursor.connection]
+        if sql not in prepared:
+            prepared.add(sql)
+            self.prepares += 1
+        self.executions += 1
+        self.statements.add(sql)
+        return cursor.execute(sql, args)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "executions": self.executions,
+            "statements": len(self.statements),
+            "prepares": self.prepares,
+            "reused": self.executions - self.prepares,
+            "cached_statements": self.cached_statements,
+        }
+
+    def release(self):
+        cursor: Cursor | None = getattr(self.local, "cursor", None)
+        if cursor is not None:
+            self.local.cursor = None
+            if self.idle.qsize() < self.size:
+                self.idle.put(cursor.connection)
+            else:
+                self.prepared.pop(cursor.connection, None)
+                cursor.connection.close()
+
+    def version(self, tables: tuple[str, ...]) -> tuple[int, ...]:
+        return tuple(self.versions.get(x, 0) for x in tables)
+
+    @contextmanager
+    def transaction(self, *tables: str) -> Generator[Cursor, None, None]:
+        with self.write_lock:
+            self.writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.writer.cursor()
+            except:
+                if self.writer.in_transaction:
+                    self.writer.execute("ROLLBACK")
+                raise
+            self.writer.execute("COMMIT")
+            for x in tables:
+                self.versions[x] = self.versions.get(x, 0) + 1
+
+    def close(self):
+        self.release()
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+        self.writer.close()
+        self.prepared.clear()
+
+
+T = TypeVar("T")
+database = Database(join(dirname(__file__), "database.db"))
+execute = database.execute
+aggregates = LRUCache(1024, 300)
+sessions = LRUCache(1024, 300)
+
+
+def aggregate(*tables: str):
+    def decorator(fn: Callable[..., T]) -> Callable[..., T]:
+        @wraps(fn)
+        def wrapper(*args: Any) -> T:
+            key = (fn.__qualname__, args, database.version(tables))
+            return aggregates.get_or_set(key, lambda: fn(*args))
+
+        return wrapper
+
+    return decorator
+
+
+migrations = [
     """
   CREATE TABLE IF NOT EXISTS users (
     user_id   INTEGER PRIMARY KEY ON CONFLICT ROLLBACK AUTOINCREMENT
@@ -48,10 +164,7 @@ execute(
                       DEFAULT ""
   )
   STRICT;
-"""
-)
-execute(
-    """
+
   CREATE TABLE IF NOT EXISTS articles (
     article_id    INTEGER PRIMARY KEY ON CONFLICT ROLLBACK AUTOINCREMENT
                           UNIQUE ON CONFLICT ROLLBACK
@@ -73,10 +186,7 @@ execute(
                           DEFAULT ""
   )
   STRICT;
-"""
-)
-execute(
-    """
+
   CREATE TRIGGER IF NOT EXISTS after_insert_article
          AFTER INSERT
             ON articles
@@ -85,10 +195,7 @@ execute(
         SET article_slug = NEW.article_slug || '-' || NEW.article_id
       WHERE article_id = NEW.article_id;
   END;
-"""
-)
-execute(
-    """
+
   CREATE TRIGGER IF NOT EXISTS after_update_article
          AFTER UPDATE OF article_id,
                          user_id,
@@ -102,10 +209,7 @@ execute(
         SET article_mtime = unixepoch()
       WHERE article_id = NEW.article_id;
   END;
-"""
-)
-execute(
-    """
+
   CREATE TABLE IF NOT EXISTS comments (
     comment_id    INTEGER PRIMARY KEY ON CONFLICT ROLLBACK AUTOINCREMENT
                           UNIQUE ON CONFLICT ROLLBACK
@@ -123,10 +227,7 @@ execute(
                           DEFAULT (0)
   )
   STRICT;
-"""
-)
-execute(
-    """
+
   CREATE TRIGGER IF NOT EXISTS after_insert_comment
          AFTER INSERT
             ON comments
@@ -135,10 +236,7 @@ execute(
         SET comment_ctime = unixepoch()
       WHERE comment_id = NEW.comment_id;
   END;
-"""
-)
-execute(
-    """
+
   CREATE TABLE IF NOT EXISTS tags (
     tag_value  TEXT    NOT NULL ON CONFLICT ROLLBACK
                        DEFAULT "",
@@ -153,10 +251,7 @@ execute(
   )
   WITHOUT ROWID,
   STRICT;
-"""
-)
-execute(
-    """
+
   CREATE TABLE IF NOT EXISTS likes (
     user_id    INTEGER REFERENCES users (user_id) ON DELETE CASCADE
                        NOT NULL ON CONFLICT ROLLBACK
@@ -172,10 +267,7 @@ execute(
   )
   WITHOUT ROWID,
   STRICT;
-"""
-)
-execute(
-    """
+
   CREATE TABLE IF NOT EXISTS follows (
     follower_id INTEGER REFERENCES users (user_id) ON DELETE CASCADE
                         NOT NULL ON CONFLICT ROLLBACK
@@ -191,9 +283,219 @@ execute(
   )
   WITHOUT ROWID,
   STRICT;
-"""
-)
-commit()
+""",
+    """
+  ALTER TABLE articles
+    ADD COLUMN likes_count INTEGER NOT NULL ON CONFLICT ROLLBACK
+                                   DEFAULT (0);
+
+  UPDATE articles
+    SET likes_count = (
+      SELECT COUNT(*)
+      FROM likes
+      WHERE likes.article_id = articles.article_id
+    );
+
+  ALTER TABLE users
+    ADD COLUMN follows_count INTEGER NOT NULL ON CONFLICT ROLLBACK
+                                     DEFAULT (0);
+
+  UPDATE users
+    SET follows_count = (
+      SELECT COUNT(*)
+      FROM follows
+      WHERE follows.followee_id = users.user_id
+    );
+
+  CREATE TRIGGER IF NOT EXISTS after_insert_like
+         AFTER INSERT
+            ON likes
+  BEGIN
+      UPDATE articles
+        SET likes_count = likes_count + 1
+      WHERE article_id = NEW.article_id;
+  END;
+
+  CREATE TRIGGER IF NOT EXISTS after_delete_like
+         AFTER DELETE
+            ON likes
+  BEGIN
+      UPDATE articles
+        SET likes_count = likes_count - 1
+      WHERE article_id = OLD.article_id;
+  END;
+
+  CREATE TRIGGER IF NOT EXISTS after_insert_follow
+         AFTER INSERT
+            ON follows
+  BEGIN
+      UPDATE users
+        SET follows_count = follows_count + 1
+      WHERE user_id = NEW.followee_id;
+  END;
+
+  CREATE TRIGGER IF NOT EXISTS after_delete_follow
+         AFTER DELETE
+            ON follows
+  BEGIN
+      UPDATE users
+        SET follows_count = follows_count - 1
+      WHERE user_id = OLD.followee_id;
+  END;
+""",
+    """
+  CREATE INDEX IF NOT EXISTS articles_article_mtime
+      ON articles (article_mtime, article_id);
+
+  CREATE INDEX IF NOT EXISTS articles_user_id
+      ON articles (user_id, article_mtime);
+
+  CREATE INDEX IF NOT EXISTS comments_article_id
+      ON comments (article_id);
+
+  CREATE INDEX IF NOT EXISTS tags_article_id
+      ON tags (article_id);
+
+  CREATE INDEX IF NOT EXISTS likes_article_id
+      ON likes (article_id);
+
+  CREATE INDEX IF NOT EXISTS follows_followee_id
+      ON follows (followee_id);
+""",
+    """
+  ALTER TABLE articles ADD COLUMN long_html TEXT NOT NULL DEFAULT '';
+  ALTER TABLE articles ADD COLUMN html_version TEXT NOT NULL DEFAULT '';
+  ALTER TABLE comments ADD COLUMN comment_html TEXT NOT NULL DEFAULT '';
+  ALTER TABLE comments ADD COLUMN html_version TEXT NOT NULL DEFAULT '';
+  ALTER TABLE users ADD COLUMN bio_html TEXT NOT NULL DEFAULT '';
+  ALTER TABLE users ADD COLUMN html_version TEXT NOT NULL DEFAULT '';
+""",
+    """
+  CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING fts5 (
+    article_title,
+    short,
+    long,
+    tags
+  );
+
+  INSERT INTO articles_fts (rowid, article_title, short, long, tags)
+  SELECT
+    articles.article_id,
+    articles.article_title,
+    articles.short,
+    articles.long,
+    COALESCE(
+      (
+        SELECT group_concat(tags.tag_value, ' ')
+        FROM tags
+        WHERE tags.article_id = articles.article_id
+      ),
+      ''
+    )
+  FROM articles;
+
+  CREATE TRIGGER IF NOT EXISTS after_insert_article_fts
+         AFTER INSERT
+            ON articles
+  BEGIN
+      INSERT INTO articles_fts (rowid, article_title, short, long, tags)
+      VALUES (NEW.article_id, NEW.article_title, NEW.short, NEW.long, '');
+  END;
+
+  CREATE TRIGGER IF NOT EXISTS after_update_article_fts
+         AFTER UPDATE OF article_title,
+                         short,
+                         long
+            ON articles
+  BEGIN
+      UPDATE articles_fts
+        SET article_title = NEW.article_title,
+            short = NEW.short,
+            long = NEW.long
+      WHERE rowid = NEW.article_id;
+  END;
+
+  CREATE TRIGGER IF NOT EXISTS after_delete_article_fts
+         AFTER DELETE
+            ON articles
+  BEGIN
+      DELETE FROM articles_fts
+      WHERE rowid = OLD.article_id;
+  END;
+
+  CREATE TRIGGER IF NOT EXISTS after_insert_tag_fts
+         AFTER INSERT
+            ON tags
+  BEGIN
+      UPDATE articles_fts
+        SET tags = (
+          SELECT group_concat(tags.tag_value, ' ')
+          FROM tags
+          WHERE tags.article_id = NEW.article_id
+        )
+      WHERE rowid = NEW.article_id;
+  END;
+
+  CREATE TRIGGER IF NOT EXISTS after_delete_tag_fts
+         AFTER DELETE
+            ON tags
+  BEGIN
+      UPDATE articles_fts
+        SET tags = COALESCE(
+          (
+            SELECT group_concat(tags.tag_value, ' ')
+            FROM tags
+            WHERE tags.article_id = OLD.article_id
+          ),
+          ''
+        )
+      WHERE rowid = OLD.article_id;
+  END;
+""",
+]
+
+
+def migrate():
+    with database.write_lock:
+        writer = database.writer
+        (version,) = writer.execute("PRAGMA user_version").fetchone()
+        for version, script in enumerate(migrations[version:], version + 1):
+            try:
+                writer.executescript(
+                    f"BEGIN;{script}PRAGMA user_version = {version};COMMIT;"
+                )
+            except:
+                if writer.in_transaction:
+                    writer.execute("ROLLBACK")
+                raise
+
+
+def rerender():
+    for table, key, source, target in (
+        ("articles", "article_id", "long", "long_html"),
+        ("comments", "comment_id", "comment_text", "comment_html"),
+        ("users", "user_id", "bio", "bio_html"),
+    ):
+        rows = execute(
+            f"SELECT {key}, {source} FROM {table} WHERE html_version != ?",
+            (markdown_version,),
+        ).fetchall()
+        if not len(rows):
+            continue
+        with database.transaction(table) as cursor:
+            cursor.executemany(
+                f"""
+          UPDATE {table}
+          SET {target} = ?, html_version = ?
+          WHERE {key} = ?
+        """,
+                [(render_markdown(x[1]), markdown_version, x[0]) for x in rows],
+            )
+    database.release()
+
+
+migrate()
+rerender()
 
 
 class User(NamedTuple):
@@ -203,14 +505,24 @@ class User(NamedTuple):
     email: str
     bio: str
     avatar: str
+    bio_html: str
     total_follows: int
     is_followed: bool
 
     @classmethod
     def public_fields(cls):
-        return ["user_id", "username", "user_slug", "email", "bio", "avatar"]
+        return [
+            "user_id",
+            "username",
+            "user_slug",
+            "email",
+            "bio",
+            "avatar",
+            "bio_html",
+        ]
 
     @classmethod
+    @cache
     def public_sql(cls):
         return f"users.{', users.'.join(cls.public_fields())}"
 
@@ -230,16 +542,26 @@ class Article(NamedTuple):
     article_mtime: int
     short: str
     long: str
+    long_html: str
     total_likes: int
     is_liked: bool
     author: User
+    loader: "ArticleLoader | None" = None
 
     @property
     def tags(self):
+        if self.loader:
+            return self.loader.get_tags(self.article_id)
         return TagController.get_article_tags(self.article_id)
 
+    @property
+    def cursor(self):
+        return f"{self.article_mtime}-{self.article_id}"
+
     @property
     def comments(self):
+        if self.loader:
+            return self.loader.get_comments(self.article_id)
         return CommentController.get_article_comments(self.article_id)
 
     @classmethod
@@ -252,9 +574,11 @@ class Article(NamedTuple):
             "article_mtime",
             "short",
             "long",
+            "long_html",
         ]
 
     @classmethod
+    @cache
     def public_sql(cls):
         return f"articles.{', articles.'.join(cls.public_fields())}"
 
@@ -264,6 +588,7 @@ class Comment(NamedTuple):
     user_id: int
     article_id: int
     comment_text: str
+    comment_html: str
     comment_ctime: int
     commenter: User
 
@@ -274,58 +599,74 @@ class Comment(NamedTuple):
             "user_id",
             "article_id",
             "comment_text",
+            "comment_html",
             "comment_ctime",
         ]
 
     @classmethod
+    @cache
     def public_sql(cls):
         return f"comments.{', comments.'.join(cls.public_fields())}"
 
 
+class ArticleLoader:
+
+    def __init__(self, article_ids: list[int]):
+        self.article_ids = article_ids
+        self.tags: dict[int, list[str]] | None = None
+        self.comments: dict[int, list[Comment]] | None = None
+
+    def get_tags(self, article_id: int) -> list[str]:
+        if self.tags is None:
+            self.tags = TagController.get_articles_tags(self.article_ids)
+        return self.tags.get(article_id, [])
+
+    def get_comments(self, article_id: int) -> list[Comment]:
+        if self.comments is None:
+            self.comments = CommentController.get_articles_comments(
+                self.article_ids
+            )
+        return self.comments.get(article_id, [])
+
+
 class UserController:
 
     @staticmethod
-    def find(
-        follower_id: int | None = None,
-        followee_id: int | None = None,
-        user_slug: str | None = None,
-    ):
+    @cache
+    def find_sql(followed: bool, by_id: bool, by_slug: bool) -> str:
         join: list[str] = []
-        join_args: list[str | int] = []
         where: list[str] = []
-        where_args: list[str | int] = []
-        if follower_id:
+        if followed:
             join.append(
-                """LEFT JOIN (
-        SELECT follows.followee_id, COUNT(*) AS follows_count
-        FROM follows
-        WHERE follows.follower_id = ?
-        GROUP BY follows.followee_id
-      ) AS user_follows ON users.user_id = user_follows.followee_id"""
+                """LEFT JOIN follows AS user_follows
+        ON users.user_id = user_follows.followee_id
+        AND user_follows.follower_id = ?"""
             )
-            join_args.append(follower_id)
-        if followee_id:
+        if by_id:
             where.append("users.user_id = ?")
-            where_args.append(followee_id)
-        if user_slug:
+        if by_slug:
             where.append("users.user_slug = ?")
-            where_args.append(user_slug)
-        result = execute(
-            f"""
+        return f"""
           SELECT
-            COALESCE(total_follows.follows_count, 0),
-            {'COALESCE(user_follows.follows_count, 0)' if follower_id else '0'},
+            users.follows_count,
+            {'user_follows.follower_id IS NOT NULL' if followed else '0'},
             {User.public_sql()}
           FROM users
-          LEFT JOIN (
-            SELECT follows.followee_id, COUNT(*) AS follows_count
-            FROM follows
-            GROUP BY follows.followee_id
-          ) AS total_follows ON users.user_id = total_follows.followee_id
           {' '.join(join) if len(join) else ''}
           {f'WHERE {" AND ".join(where)}' if len(where) else ''}
-        """,
-            tuple(join_args + where_args),
+        """
+
+    @classmethod
+    def find(
+        cls,
+        follower_id: int | None = None,
+        followee_id: int | None = None,
+        user_slug: str | None = None,
+    ):
+        args = [x for x in (follower_id, followee_id, user_slug) if x]
+        result = execute(
+            cls.find_sql(bool(follower_id), bool(followee_id), bool(user_slug)),
+            args,
         ).fetchone()
         if result:
             return User(
@@ -334,6 +675,12 @@ class UserController:
                 is_followed=bool(result[1]),
             )
 
+    @classmethod
+    def get_session(cls, user_id: int) -> User | None:
+        return sessions.get_or_set(
+            user_id, lambda: cls.find(followee_id=user_id)
+        )
+
     @staticmethod
     def insert(form_data: dict[str, list[str]]) -> tuple[int | None, list[str]]:
         errors: list[str] = []
@@ -349,23 +696,27 @@ class UserController:
         if not username or not email or not password or len(errors):
             return None, errors
         try:
-            execute(
-                """
-          INSERT INTO users (username, user_slug, email, avatar, salt, password)
-          VALUES (?, ?, ?, ?, ?, ?)
-        """,
-                (
-                    username,
-                    generate_slug(username),
-                    email,
-                    generate_gravatar_url(email),
-                    *hash_password(password),
-                ),
-            )
-            commit()
+            with database.transaction("users") as cursor:
+                cursor.execute(
+                    """
+              INSERT INTO users (
+                username, user_slug, email, avatar, salt, password, html_version
+              )
+              VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+                    (
+                        username,
+                        generate_slug(username),
+                        email,
+                        generate_gravatar_url(email),
+                        *hash_password(password),
+                        markdown_version,
+                    ),
+                )
         except:
             errors.append("Username or Email already taken")
             return None, errors
+        sessions.delete(cursor.lastrowid)
         return cursor.lastrowid, []
 
     @staticmethod
@@ -440,6 +791,12 @@ class UserController:
         fields.append("bio = ?")
         args.append(bio)
         patch["bio"] = bio
+        fields.append("bio_html = ?")
+        bio_html = render_markdown(bio)
+        args.append(bio_html)
+        patch["bio_html"] = bio_html
+        fields.append("html_version = ?")
+        args.append(markdown_version)
         if password:
             fields.append("salt = ?")
             fields.append("password = ?")
@@ -448,24 +805,40 @@ class UserController:
             args.append(pwd)
         args.append(user.user_id)
         try:
-            execute(
-                f"""
-          UPDATE users
-          SET {', '.join(fields)}
-          WHERE users.user_id = ?
-        """,
-                tuple(args),
-            )
-            commit()
+            with database.transaction("users") as cursor:
+                cursor.execute(
+                    f"""
+              UPDATE users
+              SET {', '.join(fields)}
+              WHERE users.user_id = ?
+            """,
+                    tuple(args),
+                )
         except:
             return None, ["Username or Email already taken"]
+        sessions.delete(user.user_id)
         return user._replace(**patch), []
 
 
+fts_weights = ("10.0", "2.0", "1.0", "5.0")
+
+
+def fts_query(query: str | None) -> str:
+    terms = (query or "").split()
+    return " ".join(f'"{x.replace('"', '""')}"*' for x in terms)
+
+
+article_end = 4 + len(Article.public_fields())
+user_end = article_end + len(User.public_fields())
+comment_end = len(Comment.public_fields())
+
+
 class ArticleController:
 
     @classmethod
-    def get_by_article_slug(cls, user: User | None, article_slug: str | None):
+    def get_by_article_slug(
+        cls, user: User | None, article_slug: str | None
+    ) -> Article | None:
         if not article_slug:
             return
         res = cls.search(
@@ -474,6 +847,7 @@ class ArticleController:
         return res[0] if len(res) else None
 
     @staticmethod
+    @aggregate("articles")
     def get_total_article_count() -> int:
         result = execute(
             """
@@ -484,6 +858,7 @@ class ArticleController:
         return result[0] if result else 0
 
     @staticmethod
+    @aggregate("articles", "follows")
     def get_followed_article_count(user: User | None) -> int:
         if not user:
             return 0
@@ -499,6 +874,23 @@ class ArticleController:
         return result[0] if result else 0
 
     @staticmethod
+    @aggregate("articles", "tags")
+    def get_search_article_count(query: str | None) -> int:
+        match = fts_query(query)
+        if not match:
+            return 0
+        result = execute(
+            """
+          SELECT COUNT(*)
+          FROM articles_fts
+          WHERE articles_fts MATCH ?
+        """,
+            (match,),
+        ).fetchone()
+        return result[0] if result else 0
+
+    @staticmethod
+    @aggregate("articles", "tags")
     def get_tag_article_count(tag_value: str | None) -> int:
         if not tag_value:
             return 0
@@ -514,6 +906,7 @@ class ArticleController:
         return result[0] if result else 0
 
     @staticmethod
+    @aggregate("articles")
     def get_author_article_count(user: User | None) -> int:
         if not user:
             return 0
@@ -528,6 +921,7 @@ class ArticleController:
         return result[0] if result else 0
 
     @staticmethod
+    @aggregate("likes")
     def get_liked_article_count(user: User | None) -> int:
         if not user:
             return 0
@@ -542,111 +936,139 @@ class ArticleController:
         return result[0] if result else 0
 
     @staticmethod
-    def search(
-        user_id: int | None,
-        page: int,
-        feed: bool = False,
-        tag_value: str | None = None,
-        owner_id: int | None = None,
-        liked: bool = False,
-        article_slug: str | None = None,
-    ):
+    @cache
+    def search_sql(
+        authenticated: bool,
+        feed: bool,
+        tagged: bool,
+        owned: bool,
+        liked: bool,
+        by_slug: bool,
+        after: bool,
+        matched: bool = False,
+    ) -> str:
         join: list[str] = []
-        join_args: list[str | int] = []
         where: list[str] = []
-        where_args: list[str | int] = []
-        if user_id:
+        order = "articles.article_mtime DESC, articles.article_id DESC"
+        if authenticated:
             join.append(
-                """LEFT JOIN (
-        SELECT likes.article_id, COUNT(*) AS likes_count
-        FROM likes
-        WHERE likes.user_id = ?
-        GROUP BY likes.article_id
-      ) AS user_likes ON articles.article_id = user_likes.article_id"""
+                """LEFT JOIN likes AS user_likes
+        ON articles.article_id = user_likes.article_id
+        AND user_likes.user_id = ?"""
             )
-            join_args.append(user_id)
             join.append(
-                """LEFT JOIN (
-        SELECT follows.followee_id, COUNT(*) AS follows_count
-        FROM follows
-        WHERE follows.follower_id = ?
-        GROUP BY follows.followee_id
-      ) AS user_follows ON articles.user_id = user_follows.followee_id"""
+                """LEFT JOIN follows AS user_follows
+        ON articles.user_id = user_follows.followee_id
+        AND user_follows.follower_id = ?"""
             )
-            join_args.append(user_id)
             if feed:
                 join.append(
                     "LEFT JOIN follows ON articles.user_id = follows.followee_id"
                 )
                 where.append("follows.follower_id = ?")
-                where_args.append(user_id)
-        if tag_value:
+        if tagged:
             join.append(
                 "LEFT JOIN tags ON articles.article_id = tags.article_id"
             )
             where.append("tags.tag_value = ?")
-            where_args.append(tag_value)
-        if owner_id:
+        if owned:
             if liked:
                 join.append(
-                    """LEFT JOIN (
-          SELECT likes.article_id, COUNT(*) AS likes_count
-          FROM likes
-          WHERE likes.user_id = ?
-          GROUP BY likes.article_id
-        ) AS owner_likes ON articles.article_id = owner_likes.article_id"""
+                    """JOIN likes AS owner_likes
+        ON articles.article_id = owner_likes.article_id
+        AND owner_likes.user_id = ?"""
                 )
-                join_args.append(owner_id)
-                where.append("owner_likes.likes_count > 0")
             else:
                 where.append("articles.user_id = ?")
-                where_args.append(owner_id)
-        if article_slug:
+        if by_slug:
             where.append("articles.article_slug = ?")
-            where_args.append(article_slug)
-        sql = f"""
+        if matched:
+            join.append(
+                "JOIN articles_fts ON articles.article_id = articles_fts.rowid"
+            )
+            where.append("articles_fts MATCH ?")
+            order = f"bm25(articles_fts, {', '.join(fts_weights)}), {order}"
+        elif after:
+            where.append(
+                "(articles.article_mtime, articles.article_id) < (?, ?)"
+            )
+        return f"""
       SELECT
-        COALESCE(total_likes.likes_count, 0),
-        {'COALESCE(user_likes.likes_count, 0)' if user_id else '0'},
-        COALESCE(total_follows.follows_count, 0),
-        {'COALESCE(user_follows.follows_count, 0)' if user_id else '0'},
+        articles.likes_count,
+        {'user_likes.user_id IS NOT NULL' if authenticated else '0'},
+        users.follows_count,
+        {'user_follows.follower_id IS NOT NULL' if authenticated else '0'},
         {Article.public_sql()},
         {User.public_sql()}
       FROM articles
       JOIN users ON articles.user_id = users.user_id
-      LEFT JOIN (
-        SELECT likes.article_id, COUNT(*) AS likes_count
-        FROM likes
-        GROUP BY likes.article_id
-      ) AS total_likes ON articles.article_id = total_likes.article_id
-      LEFT JOIN (
-        SELECT follows.followee_id, COUNT(*) AS follows_count
-        FROM follows
-        GROUP BY follows.followee_id
-      ) AS total_follows ON articles.user_id = total_follows.followee_id
       {' '.join(join) if len(join) else ''}
       {f'WHERE {" AND ".join(where)}' if len(where) else ''}
-      ORDER BY articles.article_mtime DESC
+      ORDER BY {order}
       LIMIT 10 OFFSET ?
     """
-        args = tuple(join_args + where_args + [10 * (page - 1)])
+
+    @classmethod
+    def search(
+        cls,
+        user_id: int | None,
+        page: int,
+        feed: bool = False,
+        tag_value: str | None = None,
+        owner_id: int | None = None,
+        liked: bool = False,
+        article_slug: str | None = None,
+        cursor: tuple[int, int] | None = None,
+        query: str | None = None,
+    ) -> list[Article]:
+        feed = bool(user_id and feed)
+        liked = bool(owner_id and liked)
+        match = fts_query(query)
+        if query is not None and not match:
+            return []
+        if match:
+            cursor = None
+        args: list[str | int] = [user_id, user_id] if user_id else []
+        if owner_id and liked:
+            args.append(owner_id)
+        if user_id and feed:
+            args.append(user_id)
+        if tag_value:
+            args.append(tag_value)
+        if owner_id and not liked:
+            args.append(owner_id)
+        if article_slug:
+            args.append(article_slug)
+        if match:
+            args.append(match)
+        if cursor:
+            args.extend(cursor)
+        args.append(0 if cursor else 10 * (page - 1))
+        sql = cls.search_sql(
+            bool(user_id),
+            feed,
+            bool(tag_value),
+            bool(owner_id),
+            liked,
+            bool(article_slug),
+            bool(cursor),
+            bool(match),
+        )
+        rows = execute(sql, args).fetchall()
+        loader = ArticleLoader([x[4] for x in rows])
         return [
             Article(
-                *x[4 : 4 + len(Article.public_fields())],
+                *x[4:article_end],
                 total_likes=x[0],
                 is_liked=bool(x[1]),
                 author=User(
-                    *x[
-                        4
-                        + len(Article.public_fields()) : 4
-                        + len(Article.public_fields())
-                        + len(User.public_fields())
-                    ],
+                    *x[article_end:user_end],
                     total_follows=x[2],
                     is_followed=bool(x[3]),
                 ),
+                loader=loader,
             )
-            for x in execute(sql, args).fetchall()
+            for x in rows
         ]
 
     @classmethod
@@ -688,39 +1110,51 @@ class ArticleController:
             else short
         )
         slug = f"{generate_slug(article_title)}-{article.article_id}"
-        execute(
-            """
-        UPDATE articles
-        SET
-          article_title = ?,
-          article_slug = ?,
-          short = ?,
-          long = ?
-        WHERE article_id = ?
-      """,
-            (article_title, slug, short, long, article.article_id),
-        )
-        execute(
-            """
-        DELETE FROM tags
-        WHERE tags.article_id = ?
-      """,
-            (article.article_id,),
-        )
-        executemany(
-            """
-        INSERT INTO tags (tag_value, article_id)
-        VALUES (?, ?)
-      """,
-            [(x, article.article_id) for x in tags],
-        )
-        commit()
+        long_html = render_markdown(long)
+        with database.transaction("articles", "tags") as cursor:
+            cursor.execute(
+                """
+            UPDATE articles
+            SET
+              article_title = ?,
+              article_slug = ?,
+              short = ?,
+              long = ?,
+              long_html = ?,
+              html_version = ?
+            WHERE article_id = ?
+          """,
+                (
+                    article_title,
+                    slug,
+                    short,
+                    long,
+                    long_html,
+                    markdown_version,
+                    article.article_id,
+                ),
+            )
+            cursor.execute(
+                """
+            DELETE FROM tags
+            WHERE tags.article_id = ?
+          """,
+                (article.article_id,),
+            )
+            cursor.executemany(
+                """
+            INSERT INTO tags (tag_value, article_id)
+            VALUES (?, ?)
+          """,
+                [(x, article.article_id) for x in tags],
+            )
         return (
             article._replace(
                 article_title=article_title,
                 article_slug=slug,
                 short=short,
                 long=long,
+                long_html=long_html,
                 article_mtime=int(time()),
             ),
             [],
@@ -755,24 +1189,36 @@ class ArticleController:
             if len(short) > max_len
             else short
         )
-        execute(
-            """
-        INSERT INTO articles (user_id, article_title, article_slug, short, long)
-        VALUES (?, ?, ?, ?, ?)
-      """,
-            (user.user_id, article_title, slug, short, long),
-        )
-        commit()
-        article_id = cursor.lastrowid
-        if article_id:
-            executemany(
+        long_html = render_markdown(long)
+        with database.transaction("articles", "tags") as cursor:
+            cursor.execute(
                 """
-          INSERT INTO tags (tag_value, article_id)
-          VALUES (?, ?)
+          INSERT INTO articles (
+            user_id, article_title, article_slug, short, long, long_html,
+            html_version
+          )
+          VALUES (?, ?, ?, ?, ?, ?, ?)
         """,
-                [(x, article_id) for x in tags],
+                (
+                    user.user_id,
+                    article_title,
+                    slug,
+                    short,
+                    long,
+                    long_html,
+                    markdown_version,
+                ),
             )
-            commit()
+            article_id = cursor.lastrowid
+            if article_id:
+                cursor.executemany(
+                    """
+            INSERT INTO tags (tag_value, article_id)
+            VALUES (?, ?)
+          """,
+                    [(x, article_id) for x in tags],
+                )
+        if article_id:
             return (
                 Article(
                     article_id,
@@ -782,6 +1228,7 @@ class ArticleController:
                     int(time()),
                     short,
                     long,
+                    long_html,
                     0,
                     False,
                     user,
@@ -794,15 +1241,15 @@ class ArticleController:
     def remove(user: User | None, article_id: int):
         if not user:
             return "Need to be logged in to remove an article"
-        execute(
-            """
-        DELETE FROM articles
-        WHERE articles.article_id = ?
-        AND articles.user_id = ?
-      """,
-            (article_id, user.user_id),
-        )
-        commit()
+        with database.transaction("articles") as cursor:
+            cursor.execute(
+                """
+            DELETE FROM articles
+            WHERE articles.article_id = ?
+            AND articles.user_id = ?
+          """,
+                (article_id, user.user_id),
+            )
         if cursor.rowcount < 1:
             return "No article removed"
 
@@ -810,6 +1257,7 @@ class ArticleController:
 class TagController:
 
     @staticmethod
+    @aggregate("tags")
     def get_most_popular_count() -> int:
         result = execute(
             """
@@ -826,6 +1274,7 @@ class TagController:
         return result[0] if result else 0
 
     @staticmethod
+    @aggregate("tags")
     def get_most_popular() -> list[str]:
         return [
             x
@@ -855,6 +1304,23 @@ class TagController:
             ).fetchall()
         ]
 
+    @staticmethod
+    def get_articles_tags(article_ids: list[int]) -> dict[int, list[str]]:
+        result: dict[int, list[str]] = {x: [] for x in article_ids}
+        if not len(article_ids):
+            return result
+        for tag_value, article_id in execute(
+            f"""
+        SELECT tags.tag_value, tags.article_id
+        FROM tags
+        WHERE tags.article_id IN ({', '.join('?' * len(article_ids))})
+        ORDER BY tags.tag_value
+      """,
+            tuple(article_ids),
+        ).fetchall():
+            result[article_id].append(tag_value)
+        return result
+
 
 class CommentController:
 
@@ -862,9 +1328,9 @@ class CommentController:
     def get_article_comments(article_id: int):
         return [
             Comment(
-                *x[0 : len(Comment.public_fields())],
+                *x[:comment_end],
                 commenter=User(
-                    *x[len(Comment.public_fields()) :],
+                    *x[comment_end:],
                     # can't follow a commenter
                     total_follows=0,
                     is_followed=False,
@@ -883,6 +1349,37 @@ class CommentController:
             ).fetchall()
         ]
 
+    @staticmethod
+    def get_articles_comments(
+        article_ids: list[int],
+    ) -> dict[int, list[Comment]]:
+        result: dict[int, list[Comment]] = {x: [] for x in article_ids}
+        if not len(article_ids):
+            return result
+        for x in execute(
+            f"""
+        SELECT
+          {Comment.public_sql()},
+          {User.public_sql()}
+        FROM comments
+        JOIN users ON comments.user_id = users.user_id
+        WHERE comments.article_id IN ({', '.join('?' * len(article_ids))})
+        ORDER BY comments.comment_id
+      """,
+            tuple(article_ids),
+        ).fetchall():
+            comment = Comment(
+                *x[:comment_end],
+                commenter=User(
+                    *x[comment_end:],
+                    # can't follow a commenter
+                    total_follows=0,
+                    is_followed=False,
+                ),
+            )
+            result[comment.article_id].append(comment)
+        return result
+
     @classmethod
     def insert(
         cls, user: User | None, article_id: int, form_data: dict[str, list[str]]
@@ -895,16 +1392,25 @@ class CommentController:
             errors.append("Need to be logged in to comment")
         if not comment_text or not user or len(errors):
             return None, errors
-        execute(
-            """
-        INSERT INTO comments (user_id, article_id, comment_text)
-        SELECT ?, articles.article_id, ?
-        FROM articles
-        WHERE articles.article_id = ?
-      """,
-            (user.user_id, comment_text, article_id),
-        )
-        commit()
+        comment_html = render_markdown(comment_text)
+        with database.transaction("comments") as cursor:
+            cursor.execute(
+                """
+            INSERT INTO comments (
+              user_id, article_id, comment_text, comment_html, html_version
+            )
+            SELECT ?, articles.article_id, ?, ?, ?
+            FROM articles
+            WHERE articles.article_id = ?
+          """,
+                (
+                    user.user_id,
+                    comment_text,
+                    comment_html,
+                    markdown_version,
+                    article_id,
+                ),
+            )
         comment_id = cursor.lastrowid
         if comment_id:
             return (
@@ -913,6 +1419,7 @@ class CommentController:
                     user.user_id,
                     article_id,
                     comment_text,
+                    comment_html,
                     int(time()),
                     user,
                 ),
@@ -925,21 +1432,37 @@ class CommentController:
     def remove(user: User | None, comment_id: int):
         if not user:
             return "Need to be logged in to remove a comment"
-        execute(
-            """
-        DELETE FROM comments
-        WHERE comments.comment_id = ?
-        AND comments.user_id = ?
-      """,
-            (comment_id, user.user_id),
-        )
-        commit()
+        with database.transaction("comments") as cursor:
+            cursor.execute(
+                """
+            DELETE FROM comments
+            WHERE comments.comment_id = ?
+            AND comments.user_id = ?
+          """,
+                (comment_id, user.user_id),
+            )
         if cursor.rowcount < 1:
             return "No comment removed"
 
 
 class LikeController:
 
+    @staticmethod
+    def is_liked(user: User | None, article_id: int) -> bool:
+        if not user:
+            return False
+        return (
+            execute(
+                """
+          SELECT 1
+          FROM likes
+          WHERE likes.user_id = ? AND likes.article_id = ?
+        """,
+                (user.user_id, article_id),
+            ).fetchone()
+            is not None
+        )
+
     @staticmethod
     def insert(
         user: User | None, article_id: int
@@ -947,21 +1470,21 @@ class LikeController:
         if not user:
             return None, "Need to be logged in to add an article to favorites"
         try:
-            execute(
-                """
-          INSERT INTO likes (user_id, article_id)
-          VALUES (?, ?)
-        """,
-                (user.user_id, article_id),
-            )
-            commit()
+            with database.transaction("likes", "articles") as cursor:
+                cursor.execute(
+                    """
+              INSERT INTO likes (user_id, article_id)
+              VALUES (?, ?)
+            """,
+                    (user.user_id, article_id),
+                )
         except:
             return None, "No article added to favorites"
         result = execute(
             """
-        SELECT COUNT(*)
-        FROM likes
-        WHERE likes.article_id = ?
+        SELECT articles.likes_count
+        FROM articles
+        WHERE articles.article_id = ?
       """,
             (article_id,),
         ).fetchone()
@@ -980,22 +1503,22 @@ class LikeController:
                 None,
                 "Need to be logged in to remove an article from favorites",
             )
-        execute(
-            """
-        DELETE FROM likes
-        WHERE likes.user_id = ?
-        AND likes.article_id = ?
-      """,
-            (user.user_id, article_id),
-        )
-        commit()
+        with database.transaction("likes", "articles") as cursor:
+            cursor.execute(
+                """
+            DELETE FROM likes
+            WHERE likes.user_id = ?
+            AND likes.article_id = ?
+          """,
+                (user.user_id, article_id),
+            )
         if cursor.rowcount < 1:
             return None, "No like removed"
         result = execute(
             """
-        SELECT COUNT(*)
-        FROM likes
-        WHERE likes.article_id = ?
+        SELECT articles.likes_count
+        FROM articles
+        WHERE articles.article_id = ?
       """,
             (article_id,),
         ).fetchone()
@@ -1008,6 +1531,22 @@ class LikeController:
 
 class FollowController:
 
+    @staticmethod
+    def is_followed(user: User | None, followee_id: int) -> bool:
+        if not user:
+            return False
+        return (
+            execute(
+                """
+          SELECT 1
+          FROM follows
+          WHERE follows.follower_id = ? AND follows.followee_id = ?
+        """,
+                (user.user_id, followee_id),
+            ).fetchone()
+            is not None
+        )
+
     @staticmethod
     def insert(
         user: User | None, user_id: int
@@ -1015,23 +1554,23 @@ class FollowController:
         if not user:
             return None, "Need to be logged in to follow a user"
         try:
-            execute(
-                """
-          INSERT INTO follows (follower_id, followee_id)
-          VALUES (?, ?)
-        """,
-                (user.user_id, user_id),
-            )
-            commit()
+            with database.transaction("follows", "users") as cursor:
+                cursor.execute(
+                    """
+              INSERT INTO follows (follower_id, followee_id)
+              VALUES (?, ?)
+            """,
+                    (user.user_id, user_id),
+                )
         except:
             return None, "No user followed"
+        sessions.delete(user_id)
         result = execute(
             """
         SELECT
-          COUNT(follows.followee_id),
+          users.follows_count,
           users.username
         FROM users
-        LEFT JOIN follows ON users.user_id = follows.followee_id
         WHERE users.user_id = ?
       """,
             (user_id,),
@@ -1051,24 +1590,24 @@ class FollowController:
     ) -> tuple[dict[str, Any] | None, str]:
         if not user:
             return None, "Need to be logged in to unfollow a user"
-        execute(
-            """
-        DELETE FROM follows
-        WHERE follows.follower_id = ?
-        AND follows.followee_id = ?
-      """,
-            (user.user_id, user_id),
-        )
-        commit()
+        with database.transaction("follows", "users") as cursor:
+            cursor.execute(
+                """
+            DELETE FROM follows
+            WHERE follows.follower_id = ?
+            AND follows.followee_id = ?
+          """,
+                (user.user_id, user_id),
+            )
         if cursor.rowcount < 1:
             return None, "No follow removed"
+        sessions.delete(user_id)
         result = execute(
             """
         SELECT
-          COUNT(follows.followee_id),
+          users.follows_count,
           users.username
         FROM users
-        LEFT JOIN follows ON users.user_id = follows.followee_id
         WHERE users.user_id = ?
       """,
             (user_id,),
@@ -1083,6 +1622,67 @@ class FollowController:
         }, ""
 
 
+def explain_queries() -> bool:
+    statements: list[str] = []
+    connection = database.cursor.connection
+    connection.set_trace_callback(statements.append)
+    try:
+        for user_id in [None, 1]:
+            user = UserController.find(followee_id=1)
+            UserController.find(follower_id=user_id, user_slug="x")
+            UserController.sign_in({"email": ["x"], "password": ["x"]})
+            ArticleController.get_by_article_slug(user, "x")
+            ArticleController.get_total_article_count()
+            ArticleController.get_followed_article_count(user)
+            ArticleController.get_tag_article_count("x")
+            ArticleController.get_search_article_count("x")
+            ArticleController.get_author_article_count(user)
+            ArticleController.get_liked_article_count(user)
+            for page, cursor in [(2, None), (2, (0, 0))]:
+                ArticleController.search(user_id, page, cursor=cursor)
+                ArticleController.search(user_id, page, True, cursor=cursor)
+                ArticleController.search(
+                    user_id, page, tag_value="x", cursor=cursor
+                )
+                ArticleController.search(
+                    user_id, page, owner_id=1, cursor=cursor
+                )
+                ArticleController.search(
+                    user_id, page, owner_id=1, liked=True, cursor=cursor
+                )
+                ArticleController.search(
+                    user_id, page, query="x", cursor=cursor
+                )
+            TagController.get_most_popular_count()
+            TagController.get_most_popular()
+            TagController.get_article_tags(1)
+            TagController.get_articles_tags([1, 2])
+            LikeController.is_liked(user, 1)
+            FollowController.is_followed(user, 1)
+            CommentController.get_article_comments(1)
+            CommentController.get_articles_comments([1, 2])
+    finally:
+        connection.set_trace_callback(None)
+    scans = 0
+    statements = [x for x in statements if not x.startswith("--")]
+    for sql in dict.fromkeys(statements):
+        for *_, detail in execute(f"EXPLAIN QUERY PLAN {sql}").fetchall():
+            if detail.startswith("SCAN ") and " INDEX " not in detail:
+                filtered = "WHERE" in sql
+                scans += filtered
+                print(
+                    f"{'FULL SCAN' if filtered else 'unfiltered'} {detail}:",
+                    " ".join(sql.split()),
+                )
+    print(f"{len(set(statements))} queries, {scans} full scans")
+    print("database:", database.stats())
+    print("find_sql:", UserController.find_sql.cache_info())
+    print("search_sql:", ArticleController.search_sql.cache_info())
+    print("aggregates:", aggregates.stats())
+    print("fragments:", fragments.stats())
+    return not scans
+
+
 class Handler(BaseHandler):
 
     SECRET = "example_secret"
@@ -1104,6 +1704,9 @@ class Handler(BaseHandler):
         ("profile_pages", "/profile/{slug}/{page}"),
         ("tag_pages", "/tag/{tag}/{page}"),
         ("tag", "/tag/{tag}"),
+        ("search", "/search"),
+        ("search_query_pages", "/search/{query}/{page}"),
+        ("search_query", "/search/{query}"),
         ("profile", "/profile/{slug}"),
         ("article", "/article/{slug}"),
         ("article_id", "/article-id/{id}"),
@@ -1115,14 +1718,66 @@ class Handler(BaseHandler):
         ("home_pages", "/{page}"),
     ]
 
+    SKELETON_ROUTES = [
+        "home",
+        "home_pages",
+        "tag",
+        "tag_pages",
+        "search_query",
+        "search_query_pages",
+        "profile",
+        "profile_pages",
+        "favorites",
+        "favorites_pages",
+        "article",
+    ]
+
+    TABLES = ("users", "articles", "tags", "comments", "likes", "follows")
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        finally:
+            database.release()
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            database.release()
+
     def set_user(self, user_id: int):
-        self.user = UserController.find(followee_id=user_id)
+        self.user = self.identity(
+            ("user", user_id), lambda: UserController.get_session(user_id)
+        )
+
+    def response_key(self):
+        return database.version(self.TABLES)
+
+    def skeleton_key(self):
+        if (
+            self.command != "GET"
+            or self.active_route not in self.SKELETON_ROUTES
+        ):
+            return None
+        tzo = self.parsed_cookies.get("tzo")
+        return (
+            self.path,
+            self.is_xhr,
+            tzo.value if tzo else None,
+            database.version(self.TABLES),
+        )
 
     @property
     def ctx_tag(self):
         tag = self.parsed_params.get("tag")
         return unquote(tag) if tag is not None else tag
 
+    @property
+    def ctx_query(self):
+        query = self.parsed_params.get("query")
+        return unquote(query) if query is not None else query
+
     @property
     def ctx_slug(self):
         return self.parsed_params.get("slug")
@@ -1137,13 +1792,44 @@ class Handler(BaseHandler):
         param = self.parsed_params.get("id")
         return int(param) if param and param.isdecimal() else -1 if param else 1
 
+    @property
+    def ctx_content_version(self):
+        return database.version(("articles", "tags"))
+
+    @property
+    def ctx_cursor(self):
+        param = self.single_parsed_query("after")
+        mtime, _, article_id = (param or "").partition("-")
+        if mtime.isdecimal() and article_id.isdecimal():
+            return int(mtime), int(article_id)
+
     @property
     def ctx_author(self):
-        return UserController.find(
-            follower_id=self.user.user_id if self.user else None,
-            user_slug=self.ctx_slug,
+        return self.identity(
+            ("author", self.ctx_slug),
+            lambda: UserController.find(user_slug=self.ctx_slug),
         )
 
+    @property
+    def ctx_liked(self) -> Callable[[int], bool]:
+        def liked(article_id: int) -> bool:
+            return self.identity(
+                ("liked", article_id),
+                lambda: LikeController.is_liked(self.user, article_id),
+            )
+
+        return liked
+
+    @property
+    def ctx_followed(self) -> Callable[[int], bool]:
+        def followed(user_id: int) -> bool:
+            return self.identity(
+                ("followed", user_id),
+                lambda: FollowController.is_followed(self.user, user_id),
+            )
+
+        return followed
+
     @property
     def ctx_popular_tag_count(self):
         return TagController.get_most_popular_count()
@@ -1160,6 +1846,10 @@ class Handler(BaseHandler):
     def ctx_tag_article_count(self):
         return ArticleController.get_tag_article_count(self.ctx_tag)
 
+    @property
+    def ctx_search_article_count(self):
+        return ArticleController.get_search_article_count(self.ctx_query)
+
     @property
     def ctx_author_article_count(self):
         return ArticleController.get_author_article_count(self.ctx_author)
@@ -1175,13 +1865,18 @@ class Handler(BaseHandler):
     @property
     def ctx_global_articles(self):
         return ArticleController.search(
-            self.user.user_id if self.user else None, self.ctx_page
+            self.user.user_id if self.user else None,
+            self.ctx_page,
+            cursor=self.ctx_cursor,
         )
 
     @property
     def ctx_feed_articles(self):
         return ArticleController.search(
-            self.user.user_id if self.user else None, self.ctx_page, feed=True
+            self.user.user_id if self.user else None,
+            self.ctx_page,
+            feed=True,
+            cursor=self.ctx_cursor,
         )
 
     @property
@@ -1190,6 +1885,15 @@ class Handler(BaseHandler):
             self.user.user_id if self.user else None,
             self.ctx_page,
             tag_value=self.ctx_tag,
+            cursor=self.ctx_cursor,
+        )
+
+    @property
+    def ctx_search_articles(self):
+        return ArticleController.search(
+            self.user.user_id if self.user else None,
+            self.ctx_page,
+            query=self.ctx_query or "",
         )
 
     @property
@@ -1198,6 +1902,7 @@ class Handler(BaseHandler):
             self.user.user_id if self.user else None,
             self.ctx_page,
             owner_id=self.ctx_author.user_id if self.ctx_author else None,
+            cursor=self.ctx_cursor,
         )
 
     @property
@@ -1207,6 +1912,7 @@ class Handler(BaseHandler):
             self.ctx_page,
             owner_id=self.ctx_author.user_id if self.ctx_author else None,
             liked=True,
+            cursor=self.ctx_cursor,
         )
 
     def get_icon(self):
@@ -1216,7 +1922,7 @@ class Handler(BaseHandler):
         self.send_file(f"../../{self.base_name}")
 
     def get_404(self):
-        self.send_tpl("index", 404, content="404")
+        self.send_tpl_stream("index", 404, content="404")
 
     def get_404_xhr(self):
         self.send_tpl("content", 404, content="404")
@@ -1225,7 +1931,7 @@ class Handler(BaseHandler):
         if self.ctx_page == -1:
             self.get_404()
         else:
-            self.send_tpl("index", content="home")
+            self.send_tpl_stream("index", content="home")
 
     def get_home_xhr(self):
         if self.ctx_page == -1:
@@ -1277,11 +1983,31 @@ class Handler(BaseHandler):
     def get_tag_pages_xhr(self):
         self.get_home_xhr()
 
+    def get_search(self):
+        query = " ".join((self.single_parsed_query("q") or "").split())
+        location = (
+            self.url("search_query", query=query) if query else self.url("home")
+        )
+        self.response_headers.append(("Location", location))
+        self.send_status(302)
+
+    def get_search_query(self):
+        self.get_home()
+
+    def get_search_query_xhr(self):
+        self.get_home_xhr()
+
+    def get_search_query_pages(self):
+        self.get_home()
+
+    def get_search_query_pages_xhr(self):
+        self.get_home_xhr()
+
     def get_profile(self):
         if self.ctx_page == -1 or not self.ctx_author:
             self.get_404()
         else:
-            self.send_tpl("index", content="profile")
+            self.send_tpl_stream("index", content="profile")
 
     def get_profile_xhr(self):
         if self.ctx_page == -1 or not self.ctx_author:
@@ -1308,13 +2034,13 @@ class Handler(BaseHandler):
         self.get_profile_xhr()
 
     def get_login(self):
-        self.send_tpl("index", content="auth")
+        self.send_tpl_stream("index", content="auth")
 
     def get_login_xhr(self):
         self.send_tpl("content", content="auth", active_route="login")
 
     def get_register(self):
-        self.send_tpl("index", content="auth")
+        self.send_tpl_stream("index", content="auth")
 
     def get_register_xhr(self):
         self.send_tpl("content", content="auth")
@@ -1324,7 +2050,7 @@ class Handler(BaseHandler):
         self.send_status(302)
 
     def get_create_auth(self):
-        self.send_tpl(
+        self.send_tpl_stream(
             "index",
             content="editor",
             article_slug="",
@@ -1357,7 +2083,7 @@ class Handler(BaseHandler):
             self.user, self.ctx_slug
         )
         if article:
-            self.send_tpl("index", content="editor", **asdict(article))
+            self.send_tpl_stream("index", content="editor", **asdict(article))
         else:
             self.get_404()
 
@@ -1369,7 +2095,7 @@ class Handler(BaseHandler):
             self.user, self.ctx_slug
         )
         if article:
-            self.send_tpl("index", content="editor", **asdict(article))
+            self.send_tpl_stream("index", content="editor", **asdict(article))
         else:
             self.get_404_xhr()
 
@@ -1378,7 +2104,7 @@ class Handler(BaseHandler):
         self.send_status(302)
 
     def get_settings_auth(self):
-        self.send_tpl("index", content="settings")
+        self.send_tpl_stream("index", content="settings")
 
     def get_settings_xhr(self):
         self.get_login_xhr()
@@ -1387,18 +2113,14 @@ class Handler(BaseHandler):
         self.send_tpl("content", content="settings")
 
     def get_article(self):
-        article = ArticleController.get_by_article_slug(
-            self.user, self.ctx_slug
-        )
+        article = ArticleController.get_by_article_slug(None, self.ctx_slug)
         if article:
-            self.send_tpl("index", content="article", **asdict(article))
+            self.send_tpl_stream("index", content="article", **asdict(article))
         else:
             self.get_404()
 
     def get_article_xhr(self):
-        article = ArticleController.get_by_article_slug(
-            self.user, self.ctx_slug
-        )
+        article = ArticleController.get_by_article_slug(None, self.ctx_slug)
         if article:
             self.send_tpl("content", content="article", **asdict(article))
         else:
@@ -1507,4 +2229,4 @@ class Handler(BaseHandler):
             self.send_string(error, 400)
 
 
-Server(("127.0.0.1", 8080), Handler).start(connection.close)
+Server(("127.0.0.1", 8080), Handler).start(database.close, explain_queries)